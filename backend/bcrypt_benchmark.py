@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Report bcrypt hash time per cost factor on the current host.
+
+Use it to choose BCRYPT_TARGET_HASH_MS for the API server:
+    python bcrypt_benchmark.py --min-rounds 10 --max-rounds 14
+"""
+
+import argparse
+import statistics
+import time
+
+import bcrypt
+
+
+def measure_ms(rounds: int, samples: int) -> list:
+    timings = []
+    for _ in range(samples):
+        salt = bcrypt.gensalt(rounds=rounds)
+        started = time.perf_counter()
+        bcrypt.hashpw(b"benchmark-password", salt)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bcrypt hash time per cost factor")
+    parser.add_argument("--min-rounds", type=int, default=10)
+    parser.add_argument("--max-rounds", type=int, default=14)
+    parser.add_argument("--samples", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'cost':>4}  {'min ms':>9}  {'median ms':>9}  {'max ms':>9}")
+    for rounds in range(args.min_rounds, args.max_rounds + 1):
+        timings = measure_ms(rounds, args.samples)
+        print(f"{rounds:>4}  {min(timings):>9.1f}  {statistics.median(timings):>9.1f}  {max(timings):>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,20 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request, Response, Header
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ASCENDING
+from pymongo import ReturnDocument
+from pymongo.errors import CollectionInvalid, DuplicateKeyError, BulkWriteError
+from pymongo import monitoring
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from cryptography.hazmat.primitives import serialization
 import os
 import logging
+import logging.handlers
+import tempfile
+import threading
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
 from typing import List, Optional, Dict, Any
@@ -17,13 +27,282 @@ from enum import Enum
 import json
 import hmac
 import hashlib
+import time
+import contextvars
+from contextlib import contextmanager
+import requests
+import fastapi.routing
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+import secrets
+import random
+import base64
+import ipaddress
+from collections import defaultdict, deque, OrderedDict
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Tracing Configuration
+TRACE_SLOW_REQUEST_MS = float(os.environ.get("TRACE_SLOW_REQUEST_MS", "500"))
+TRACE_FAST_SAMPLE_RATE = float(os.environ.get("TRACE_FAST_SAMPLE_RATE", "0"))
+# Kept traces go outside the source tree and rotate by size so the file cannot grow without limit
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", str(Path(tempfile.gettempdir()) / "vpnapp" / "traces.jsonl"))
+TRACE_EXPORT_MAX_BYTES = int(os.environ.get("TRACE_EXPORT_MAX_BYTES", str(50 * 1024 * 1024)))
+TRACE_EXPORT_BACKUP_COUNT = int(os.environ.get("TRACE_EXPORT_BACKUP_COUNT", "3"))
+TRACE_OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT")
+TRACE_EXPLAIN_COMMANDS = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+# Explains hit the production database, so each query shape is explained at most once per interval
+TRACE_EXPLAIN_INTERVAL_SECONDS = float(os.environ.get("TRACE_EXPLAIN_INTERVAL_SECONDS", "300"))
+TRACE_EXPLAIN_CONCURRENCY = int(os.environ.get("TRACE_EXPLAIN_CONCURRENCY", "2"))
+# Explain output keys that echo query literals such as emails or password hashes
+TRACE_REDACTED_EXPLAIN_KEYS = {"parsedQuery", "filter", "indexBounds", "query", "q", "u", "command", "originalCommand"}
+
+# Tracing
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start_ns", "end_ns", "attributes")
+
+    def __init__(self, name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+
+    def end(self):
+        self.end_ns = time.time_ns()
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_unix_nano": self.start_ns,
+            "end_unix_nano": self.end_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes
+        }
+
+class Trace:
+    """Spans collected for one request; kept or dropped once the request finishes"""
+
+    def __init__(self):
+        self.trace_id = secrets.token_hex(16)
+        self.spans: List[Span] = []
+        # Mongo commands in flight, keyed by pymongo request id
+        self.pending: Dict[int, Span] = {}
+        # (span, database, command) for every query that can be explained
+        self.queries: List[tuple] = []
+
+    def start_span(self, name: str, parent_id: Optional[str] = None, **attributes) -> Span:
+        span = Span(name, parent_id, attributes)
+        self.spans.append(span)
+        return span
+
+current_trace: contextvars.ContextVar = contextvars.ContextVar("current_trace", default=None)
+current_span_id: contextvars.ContextVar = contextvars.ContextVar("current_span_id", default=None)
+
+@contextmanager
+def trace_span(name: str, **attributes):
+    """Record a child span of the current request, or do nothing outside a trace"""
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+    span = trace.start_span(name, current_span_id.get(), **attributes)
+    token = current_span_id.set(span.span_id)
+    try:
+        yield span
+    finally:
+        span.end()
+        current_span_id.reset(token)
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """Turns pymongo command events into spans.
+
+    Motor runs pymongo on a thread pool but copies the caller's context, so
+    the request's trace is visible here.
+    """
+
+    def started(self, event):
+        trace = current_trace.get()
+        if trace is None:
+            return
+        span = trace.start_span(
+            f"mongo.{event.command_name}",
+            current_span_id.get(),
+            **{"db.name": event.database_name, "db.collection": str(event.command.get(event.command_name))}
+        )
+        trace.pending[event.request_id] = span
+        if event.command_name in TRACE_EXPLAIN_COMMANDS:
+            command = {k: v for k, v in event.command.items() if not k.startswith("$") and k not in ("lsid", "txnNumber")}
+            trace.queries.append((span, event.database_name, command))
+
+    def _finish(self, event, **attributes):
+        trace = current_trace.get()
+        span = trace.pending.pop(event.request_id, None) if trace else None
+        if span is not None:
+            span.attributes.update(attributes)
+            span.end()
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event, error=str(event.failure))
+
+def instrument_fastapi_validation():
+    """Wrap FastAPI's request dependency solving and response serialization in spans"""
+    solve_dependencies = fastapi.routing.solve_dependencies
+    serialize_response = fastapi.routing.serialize_response
+
+    async def traced_solve_dependencies(*args, **kwargs):
+        with trace_span("fastapi.dependencies"):
+            return await solve_dependencies(*args, **kwargs)
+
+    async def traced_serialize_response(*args, **kwargs):
+        with trace_span("pydantic.serialize_response"):
+            return await serialize_response(*args, **kwargs)
+
+    fastapi.routing.solve_dependencies = traced_solve_dependencies
+    fastapi.routing.serialize_response = traced_serialize_response
+
+def redact_values(value: Any) -> Any:
+    """Replace literal values with ? so only the shape of a query is kept"""
+    if isinstance(value, dict):
+        return {key: redact_values(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact_values(item) for item in value]
+    return "?"
+
+def redact_explain(node: Any) -> Any:
+    if isinstance(node, dict):
+        return {
+            key: redact_values(value) if key in TRACE_REDACTED_EXPLAIN_KEYS else redact_explain(value)
+            for key, value in node.items()
+        }
+    if isinstance(node, list):
+        return [redact_explain(item) for item in node]
+    return node
+
+def query_filter(command: Dict[str, Any]) -> Dict[str, Any]:
+    """Pull the filter document out of a find, aggregate or write command"""
+    name = next(iter(command))
+    if name == "update":
+        return command["updates"][0]["q"]
+    if name == "delete":
+        return command["deletes"][0]["q"]
+    if name == "findAndModify":
+        return command.get("query", {})
+    if name == "aggregate":
+        return next((stage["$match"] for stage in command["pipeline"] if "$match" in stage), {})
+    return command.get("filter", command.get("query", {}))
+
+def query_shape(database: str, command: Dict[str, Any]) -> tuple:
+    name = next(iter(command))
+    return (database, name, str(command[name]), json.dumps(redact_values(query_filter(command)), sort_keys=True))
+
+def otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": key, "value": {"stringValue": str(value)}} for key, value in attributes.items()]
+
+class TraceExporter:
+    """Writes kept traces to a JSON lines file or an OTLP/HTTP collector"""
+
+    def __init__(self):
+        self.tasks: set = set()
+        self.last_explained: Dict[tuple, float] = {}
+        self.explain_slots = asyncio.Semaphore(TRACE_EXPLAIN_CONCURRENCY)
+        self.file_handler: Optional[logging.handlers.RotatingFileHandler] = None
+        self.file_lock = threading.Lock()
+
+    def keep(self, trace: Trace, root: Span, status_code: int, slow: bool):
+        task = asyncio.create_task(self._export(trace, root, status_code, slow))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _explain(self, trace: Trace):
+        for span, database, command in trace.queries:
+            shape = query_shape(database, command)
+            now = time.monotonic()
+            if now - self.last_explained.get(shape, float("-inf")) < TRACE_EXPLAIN_INTERVAL_SECONDS:
+                span.attributes["db.explain_skipped"] = "shape explained recently"
+                continue
+            # Never queue explains behind each other while the database is struggling
+            if self.explain_slots.locked():
+                span.attributes["db.explain_skipped"] = "explain concurrency limit reached"
+                continue
+            self.last_explained[shape] = now
+            try:
+                async with self.explain_slots:
+                    plan = await client[database].command({"explain": command, "verbosity": "executionStats"})
+                span.attributes["db.explain"] = json.dumps(redact_explain({
+                    "queryPlanner": plan.get("queryPlanner"),
+                    "executionStats": {k: v for k, v in plan.get("executionStats", {}).items() if k != "allPlansExecution"}
+                }), default=str)
+            except Exception as e:
+                span.attributes["db.explain_error"] = str(e)
+
+    def _write_file(self, record: Dict[str, Any]):
+        # Runs in worker threads, so opening the file and rolling it over happen under one lock
+        with self.file_lock:
+            if self.file_handler is None:
+                Path(TRACE_EXPORT_PATH).parent.mkdir(parents=True, exist_ok=True)
+                self.file_handler = logging.handlers.RotatingFileHandler(
+                    TRACE_EXPORT_PATH, maxBytes=TRACE_EXPORT_MAX_BYTES,
+                    backupCount=TRACE_EXPORT_BACKUP_COUNT, encoding="utf-8"
+                )
+            self.file_handler.emit(logging.makeLogRecord({"msg": json.dumps(record, default=str)}))
+
+    def _post_otlp(self, trace: Trace):
+        spans = [{
+            "traceId": trace.trace_id,
+            "spanId": span.span_id,
+            "parentSpanId": span.parent_id or "",
+            "name": span.name,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns or span.start_ns),
+            "attributes": otlp_attributes(span.attributes)
+        } for span in trace.spans]
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": otlp_attributes({"service.name": app.title})},
+            "scopeSpans": [{"scope": {"name": "vpn-api"}, "spans": spans}]
+        }]}
+        requests.post(TRACE_OTLP_ENDPOINT, json=payload, timeout=5)
+
+    async def _export(self, trace: Trace, root: Span, status_code: int, slow: bool):
+        # Keep the explain commands themselves out of any trace
+        current_trace.set(None)
+        try:
+            if slow:
+                await self._explain(trace)
+            if TRACE_OTLP_ENDPOINT:
+                await asyncio.to_thread(self._post_otlp, trace)
+            else:
+                await asyncio.to_thread(self._write_file, {
+                    "trace_id": trace.trace_id,
+                    "name": root.name,
+                    "status_code": status_code,
+                    "duration_ms": round(root.duration_ms, 3),
+                    "slow": slow,
+                    "spans": [span.to_dict() for span in trace.spans]
+                })
+        except Exception as e:
+            logger.error(f"Failed to export trace {trace.trace_id}: {e}")
+
+trace_exporter = TraceExporter()
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandTracer()])
 db = client[os.environ['DB_NAME']]
 
 # JWT Configuration
@@ -31,12 +310,80 @@ JWT_SECRET = os.environ.get("JWT_SECRET", "your-secret-key-here")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
 
+# Password Hashing Configuration
+BCRYPT_TARGET_HASH_MS = float(os.environ.get("BCRYPT_TARGET_HASH_MS", "250"))
+# Floor for calibration; 12 matches the bcrypt.gensalt() default used before calibration existed
+BCRYPT_MIN_ROUNDS = int(os.environ.get("BCRYPT_MIN_ROUNDS", "12"))
+BCRYPT_MAX_ROUNDS = 16
+
+# Session Tracking Configuration
+SESSION_HEARTBEAT_INTERVAL_SECONDS = 30
+SESSION_TIMEOUT_SECONDS = 90
+SERVER_LOAD_FLUSH_SECONDS = 15
+DEFAULT_SERVER_CAPACITY = 1000
+ASSIGNMENT_RESERVATION_SECONDS = 30
+CATALOG_REFRESH_SECONDS = 60
+GUEST_CATALOG_MAX_AGE_SECONDS = 60
+GUEST_CATALOG_STALE_WHILE_REVALIDATE_SECONDS = 600
+# Live load changes with every session, so it is served apart from the cacheable catalog
+PROXY_LOAD_MAX_AGE_SECONDS = int(os.environ.get("PROXY_LOAD_MAX_AGE_SECONDS", "10"))
+# Fields ProxyServer adds on top of ProxyCatalogEntry
+VOLATILE_SERVER_FIELDS = {"load_percentage"}
+CATALOG_HISTORY_SIZE = 20
+
+# WireGuard Configuration
+WIREGUARD_KEY_POOL_SIZE = 256
+WIREGUARD_KEY_POOL_LOW_WATERMARK = 64
+WIREGUARD_CONFIG_CACHE_SIZE = 10000
+WIREGUARD_DNS = "1.1.1.1, 1.0.0.1"
+WIREGUARD_CLIENT_NETWORK = ipaddress.ip_network("10.64.0.0/10")
+# Shared secret WireGuard nodes send to pull their peer list
+WIREGUARD_NODE_TOKEN = os.environ.get("WIREGUARD_NODE_TOKEN")
+
+# Usage Accounting Configuration
+USAGE_FLUSH_SECONDS = 10
+USAGE_FLUSH_BATCH_SIZE = 1000
+USAGE_SAMPLE_RETENTION_DAYS = 30
+USAGE_MAX_BUFFERED_SAMPLES = 100000
+# Rollup batches kept for retry while Mongo is failing, and batch ids remembered per rollup document
+USAGE_MAX_PENDING_ROLLUP_BATCHES = 100
+USAGE_ROLLUP_APPLIED_HISTORY = 50
+
 # Create the main app
 app = FastAPI(title="VPN API", version="1.0.0")
 api_router = APIRouter(prefix="/api")
 
+instrument_fastapi_validation()
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Trace every request but only keep slow or failed ones (tail-based sampling)"""
+    trace = Trace()
+    trace_token = current_trace.set(trace)
+    root = trace.start_span(f"{request.method} {request.url.path}", **{"http.method": request.method, "http.route": request.url.path})
+    span_token = current_span_id.set(root.span_id)
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        root.end()
+        # Name the span after the route template so path secrets like session ids stay out of traces
+        route = request.scope.get("route")
+        if route is not None:
+            root.name = f"{request.method} {route.path}"
+            root.attributes["http.route"] = route.path
+        root.attributes["http.status_code"] = status_code
+        current_span_id.reset(span_token)
+        current_trace.reset(trace_token)
+        slow = root.duration_ms >= TRACE_SLOW_REQUEST_MS
+        if slow or status_code >= 500 or random.random() < TRACE_FAST_SAMPLE_RATE:
+            trace_exporter.keep(trace, root, status_code, slow)
+
 # Security
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 # Enums
 class ProxyType(str, Enum):
@@ -50,6 +397,10 @@ class SubscriptionTier(str, Enum):
     FREE = "free"
     PREMIUM = "premium"
 
+class UsageGranularity(str, Enum):
+    HOUR = "hour"
+    DAY = "day"
+
 # Models
 class User(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -72,7 +423,8 @@ class UserLogin(BaseModel):
 class PasswordResetRequest(BaseModel):
     email: EmailStr
 
-class ProxyServer(BaseModel):
+# A proxy server without its volatile fields, as served in cacheable catalogs
+class ProxyCatalogEntry(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
     country: str
@@ -83,10 +435,14 @@ class ProxyServer(BaseModel):
     port: int
     is_premium: bool = False
     is_online: bool = True
-    load_percentage: int = 0
     ping_ms: int = 0
+    capacity: int = DEFAULT_SERVER_CAPACITY
+    wireguard_public_key: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class ProxyServer(ProxyCatalogEntry):
+    load_percentage: int = 0
+
 class AuthResponse(BaseModel):
     access_token: str
     token_type: str = "bearer"
@@ -100,13 +456,123 @@ class UserProfile(BaseModel):
     subscription_expires_at: Optional[datetime]
     created_at: datetime
 
+class SessionStart(BaseModel):
+    proxy_id: str
+    reservation_id: Optional[str] = None
+
+class SessionInfo(BaseModel):
+    session_id: str
+    proxy_id: str
+    heartbeat_interval: int = SESSION_HEARTBEAT_INTERVAL_SECONDS
+    expires_in: int = SESSION_TIMEOUT_SECONDS
+
+class WireGuardPeer(BaseModel):
+    public_key: str
+    allowed_ips: str
+
+class WireGuardServerKey(BaseModel):
+    # Base64 of a 32-byte Curve25519 public key, as printed by `wg pubkey`
+    public_key: str = Field(pattern=r"^[A-Za-z0-9+/]{42}[AEIMQUYcgkosw480]=$")
+
+class ProxyAssignRequest(BaseModel):
+    country: Optional[str] = None
+    city: Optional[str] = None
+
+class ProxyAssignment(BaseModel):
+    server: ProxyServer
+    reservation_id: str
+    expires_in: int = ASSIGNMENT_RESERVATION_SECONDS
+
+class UsageReport(BaseModel):
+    session_id: str
+    bytes_sent: int = Field(0, ge=0)
+    bytes_received: int = Field(0, ge=0)
+    connected_seconds: int = Field(0, ge=0)
+
+class UsageBucket(BaseModel):
+    proxy_id: str
+    bucket: datetime
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    connected_seconds: int = 0
+
+class UsageSummary(BaseModel):
+    granularity: UsageGranularity
+    buckets: List[UsageBucket]
+    total_bytes_sent: int
+    total_bytes_received: int
+    total_connected_seconds: int
+
+class SubscriptionState(BaseModel):
+    tier: SubscriptionTier
+    expires_at: Optional[datetime] = None
+    is_active: bool
+    # None when usage could not be loaded; the rest of the state is still valid
+    usage_today_bytes: Optional[int] = 0
+
+class CatalogSnapshot(BaseModel):
+    version: str
+    # False when servers/removed are a delta against the client's version
+    full: bool = True
+    servers: List[ProxyServer] = []
+    removed: List[str] = []
+
+class BootstrapResponse(BaseModel):
+    profile: Optional[UserProfile] = None
+    subscription: SubscriptionState
+    catalog: CatalogSnapshot
+    recommended_server: Optional[ProxyServer] = None
+    # Live load per visible server; catalog versions deliberately ignore it
+    loads: Dict[str, int] = {}
+
 # Helper Functions
+# Cost factor for new hashes, replaced by calibrate_bcrypt_rounds() at startup
+bcrypt_rounds = BCRYPT_MIN_ROUNDS
+pending_rehashes: set = set()
+
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=bcrypt_rounds)).decode('utf-8')
 
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+def bcrypt_cost(hashed: str) -> int:
+    """Read the cost factor from a modular crypt string like $2b$12$..."""
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return 0
+
+def measure_bcrypt_ms(rounds: int) -> float:
+    salt = bcrypt.gensalt(rounds=rounds)
+    started = time.perf_counter()
+    bcrypt.hashpw(b"calibration-password", salt)
+    return (time.perf_counter() - started) * 1000
+
+def calibrate_bcrypt_rounds(target_ms: float = BCRYPT_TARGET_HASH_MS) -> int:
+    """Pick the highest cost whose hash time stays within target_ms on this host.
+
+    Each extra round doubles the work, so one measurement at the minimum cost
+    is enough to extrapolate the rest without paying for the slow ones.
+    """
+    base_ms = min(measure_bcrypt_ms(BCRYPT_MIN_ROUNDS) for _ in range(3))
+    rounds = BCRYPT_MIN_ROUNDS
+    while rounds < BCRYPT_MAX_ROUNDS and base_ms * 2 ** (rounds + 1 - BCRYPT_MIN_ROUNDS) <= target_ms:
+        rounds += 1
+    return rounds
+
+async def rehash_password(user_id: str, password: str, old_hash: str):
+    try:
+        with trace_span("bcrypt.hashpw", rounds=bcrypt_rounds):
+            new_hash = await asyncio.to_thread(hash_password, password)
+        # Only replace the hash we verified, in case the password changed meanwhile
+        await db.users.update_one(
+            {"id": user_id, "password_hash": old_hash},
+            {"$set": {"password_hash": new_hash}}
+        )
+    except Exception as e:
+        logger.error(f"Failed to rehash password for user {user_id}: {e}")
+
 def create_access_token(user_id: str, subscription_tier: str) -> str:
     payload = {
         "user_id": user_id,
@@ -132,6 +598,680 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except jwt.JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def get_token_tier(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)) -> SubscriptionTier:
+    """Read the subscription tier straight from the JWT without a database lookup.
+
+    The claim is fixed when the token is issued, so every endpoint that changes
+    a user's tier must hand back a fresh token (see upgrade_subscription).
+    """
+    if credentials is None:
+        return SubscriptionTier.FREE
+    try:
+        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return SubscriptionTier(payload.get("subscription_tier", SubscriptionTier.FREE))
+
+def verify_node_token(x_node_token: Optional[str] = Header(None)):
+    """Authenticate a WireGuard node pulling its peer list"""
+    if not WIREGUARD_NODE_TOKEN:
+        raise HTTPException(status_code=503, detail="WireGuard peer sync is not configured")
+    if not x_node_token or not hmac.compare_digest(x_node_token, WIREGUARD_NODE_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid node token")
+
+async def get_optional_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
+    """Resolve the user when a bearer token is sent, otherwise treat the caller as a guest"""
+    if credentials is None:
+        return None
+    return await get_current_user(credentials)
+
+# Session Tracking
+class ActiveSession:
+    __slots__ = ("user_id", "proxy_id", "slot", "started_at", "pending")
+
+    def __init__(self, user_id: Optional[str], proxy_id: str, slot: int, pending: bool = False):
+        self.user_id = user_id
+        self.proxy_id = proxy_id
+        self.slot = slot
+        self.started_at = datetime.utcnow()
+        # Pending sessions are capacity reservations handed out by /proxies/assign
+        self.pending = pending
+
+class SessionTracker:
+    """In-memory registry of active VPN sessions with per-server counters.
+
+    Expiry is driven by a single-level timing wheel with one-second slots, so
+    start, heartbeat, stop and expiry are all O(1) per session. Everything runs
+    on the event loop thread, so plain integer counters are updated atomically.
+    """
+
+    def __init__(self, timeout_seconds: int = SESSION_TIMEOUT_SECONDS):
+        self.timeout = timeout_seconds
+        self.wheel_size = timeout_seconds + 1
+        self.wheel = [set() for _ in range(self.wheel_size)]
+        self.tick = 0
+        self.sessions: Dict[str, ActiveSession] = {}
+        self.active_counts: Dict[str, int] = defaultdict(int)
+        self.capacities: Dict[str, int] = {}
+        self.dirty: set = set()
+
+    def _deadline_slot(self, timeout: Optional[int] = None) -> int:
+        return (self.tick + min(timeout or self.timeout, self.timeout)) % self.wheel_size
+
+    def _reschedule(self, session_id: str, session: ActiveSession, timeout: Optional[int] = None):
+        self.wheel[session.slot].discard(session_id)
+        session.slot = self._deadline_slot(timeout)
+        self.wheel[session.slot].add(session_id)
+
+    def _release(self, proxy_id: str):
+        self.active_counts[proxy_id] -= 1
+        if self.active_counts[proxy_id] <= 0:
+            del self.active_counts[proxy_id]
+        self.dirty.add(proxy_id)
+
+    def start(self, proxy_id: str, user_id: Optional[str], capacity: int = DEFAULT_SERVER_CAPACITY,
+              timeout: Optional[int] = None, pending: bool = False) -> str:
+        session_id = secrets.token_urlsafe(24)
+        slot = self._deadline_slot(timeout)
+        self.sessions[session_id] = ActiveSession(user_id, proxy_id, slot, pending)
+        self.wheel[slot].add(session_id)
+        self.active_counts[proxy_id] += 1
+        self.capacities[proxy_id] = capacity
+        self.dirty.add(proxy_id)
+        return session_id
+
+    def try_start(self, proxy_id: str, user_id: Optional[str], capacity: int,
+                  timeout: Optional[int] = None, pending: bool = False) -> Optional[str]:
+        """Start a session only if the server has room, otherwise return None.
+
+        The check and the increment happen without yielding to the event loop,
+        so concurrent callers can never oversubscribe a server.
+        """
+        if self.active_counts.get(proxy_id, 0) >= capacity:
+            return None
+        return self.start(proxy_id, user_id, capacity, timeout=timeout, pending=pending)
+
+    def reserve(self, proxy_id: str, capacity: int) -> Optional[str]:
+        """Claim a slot on a server up front for a client that will connect shortly"""
+        return self.try_start(proxy_id, None, capacity, timeout=ASSIGNMENT_RESERVATION_SECONDS, pending=True)
+
+    def claim(self, reservation_id: str, proxy_id: str, user_id: Optional[str]) -> Optional[ActiveSession]:
+        """Turn a pending reservation into a live session on the same server"""
+        session = self.sessions.get(reservation_id)
+        if session is None or not session.pending or session.proxy_id != proxy_id:
+            return None
+        session.pending = False
+        session.user_id = user_id
+        self._reschedule(reservation_id, session)
+        return session
+
+    def heartbeat(self, session_id: str) -> Optional[ActiveSession]:
+        session = self.sessions.get(session_id)
+        if session is None or session.pending:
+            return None
+        self._reschedule(session_id, session)
+        return session
+
+    def stop(self, session_id: str) -> Optional[ActiveSession]:
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return None
+        self.wheel[session.slot].discard(session_id)
+        self._release(session.proxy_id)
+        return session
+
+    def advance(self) -> int:
+        """Move the wheel forward one slot and expire every session due in it"""
+        self.tick += 1
+        bucket = self.wheel[self.tick % self.wheel_size]
+        expired = len(bucket)
+        for session_id in bucket:
+            session = self.sessions.pop(session_id)
+            self._release(session.proxy_id)
+        bucket.clear()
+        return expired
+
+    def load_fraction(self, proxy_id: str, capacity: Optional[int] = None) -> float:
+        capacity = capacity or self.capacities.get(proxy_id) or DEFAULT_SERVER_CAPACITY
+        return self.active_counts.get(proxy_id, 0) / capacity
+
+    def load_percentage(self, proxy_id: str) -> int:
+        return min(100, round(self.load_fraction(proxy_id) * 100))
+
+    def register(self, proxy_id: str, capacity: int):
+        """Track a server before its first session so the next flush overwrites any stale stored load"""
+        if proxy_id not in self.capacities:
+            self.dirty.add(proxy_id)
+        self.capacities[proxy_id] = capacity
+
+    def drain_dirty(self) -> Dict[str, int]:
+        """Return current load for every server touched since the last drain"""
+        dirty, self.dirty = self.dirty, set()
+        return {proxy_id: self.load_percentage(proxy_id) for proxy_id in dirty}
+
+    async def run_expiry(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        while True:
+            await asyncio.sleep(1)
+            # Catch up on any slots missed while the loop was busy
+            due = int(loop.time() - started)
+            while self.tick < due:
+                expired = self.advance()
+                if expired:
+                    logger.info(f"Expired {expired} sessions without heartbeat")
+
+session_tracker = SessionTracker()
+
+class CachedPayload:
+    """A JSON response body serialized once, with precompressed variants and a strong ETag"""
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.version = self.version_of(body)
+        self.encoded = {
+            "identity": self.body,
+            "gzip": gzip.compress(self.body, compresslevel=9),
+        }
+        if brotli is not None:
+            self.encoded["br"] = brotli.compress(self.body, quality=11)
+
+    @staticmethod
+    def serialize(data: Any) -> bytes:
+        return json.dumps(jsonable_encoder(data), ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+
+    @staticmethod
+    def version_of(body: bytes) -> str:
+        return hashlib.sha256(body).hexdigest()[:32]
+
+    def etag(self, encoding: str) -> str:
+        # Strong ETags must differ between content codings of the same version
+        return f'"{self.version}"' if encoding == "identity" else f'"{self.version}-{encoding}"'
+
+    def negotiate(self, accept_encoding: str) -> str:
+        accepted = set()
+        for part in accept_encoding.split(","):
+            coding, _, params = part.strip().partition(";")
+            if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                continue
+            accepted.add(coding.strip().lower())
+        for encoding in ("br", "gzip"):
+            if encoding in self.encoded and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    def matches(self, if_none_match: str) -> bool:
+        """Weak comparison as RFC 9110 requires for If-None-Match, across all codings"""
+        if if_none_match.strip() == "*":
+            return True
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return any(self.etag(encoding) in tags for encoding in self.encoded)
+
+def catalog_entry(server: ProxyServer) -> Dict[str, Any]:
+    """The stable part of a server that catalog versions and ETags are derived from"""
+    return server.dict(exclude=VOLATILE_SERVER_FIELDS)
+
+class ProxyCatalog:
+    """In-memory snapshot of proxy_servers indexed by location for request-path lookups"""
+
+    def __init__(self):
+        self.servers: Dict[str, ProxyServer] = {}
+        self.by_location: Dict[str, List[str]] = {}
+        self.guest_payload = CachedPayload(CachedPayload.serialize([]))
+        # Current catalog version per tier, and recent versions' per-server digests for deltas
+        self.tier_versions: Dict[SubscriptionTier, str] = {}
+        self.history: OrderedDict = OrderedDict()
+
+    async def refresh(self):
+        proxies = await db.proxy_servers.find({}).to_list(None)
+        servers = {}
+        by_location = defaultdict(list)
+        for proxy in proxies:
+            server = ProxyServer(**proxy)
+            servers[server.id] = server
+            for key in {server.country.lower(), server.country_code.lower(), server.city.lower()}:
+                by_location[key].append(server.id)
+        # Rendered configs embed the endpoint and server key, so drop them when those change
+        for server_id, old in self.servers.items():
+            new = servers.get(server_id)
+            if new is None or (new.host, new.port, new.wireguard_public_key) != (old.host, old.port, old.wireguard_public_key):
+                wireguard_config_cache.invalidate_proxy(server_id)
+        guest_servers = [s for s in servers.values() if not s.is_premium]
+        guest_body = CachedPayload.serialize([catalog_entry(s) for s in guest_servers])
+        guest_payload = self.guest_payload
+        # Only recompress when the guest catalog actually changed
+        if CachedPayload.version_of(guest_body) != guest_payload.version:
+            guest_payload = await asyncio.to_thread(CachedPayload, guest_body)
+        digests = {server_id: CachedPayload.version_of(CachedPayload.serialize(catalog_entry(s))) for server_id, s in servers.items()}
+        tier_versions = {}
+        for tier in SubscriptionTier:
+            visible = {
+                server_id: digest for server_id, digest in sorted(digests.items())
+                if tier == SubscriptionTier.PREMIUM or not servers[server_id].is_premium
+            }
+            version = CachedPayload.version_of(json.dumps(visible).encode('utf-8'))
+            tier_versions[tier] = version
+            self.history[version] = visible
+            self.history.move_to_end(version)
+        while len(self.history) > CATALOG_HISTORY_SIZE:
+            self.history.popitem(last=False)
+        for server in servers.values():
+            session_tracker.register(server.id, server.capacity)
+        # Swap everything at once so readers never see a half-built catalog
+        self.servers, self.by_location, self.guest_payload = servers, dict(by_location), guest_payload
+        self.tier_versions = tier_versions
+
+    def find(self, country: Optional[str] = None, city: Optional[str] = None) -> List[ProxyServer]:
+        if city:
+            ids = self.by_location.get(city.strip().lower(), [])
+        elif country:
+            ids = self.by_location.get(country.strip().lower(), [])
+        else:
+            ids = self.servers.keys()
+        servers = [self.servers[server_id] for server_id in ids]
+        if city and country:
+            wanted = country.strip().lower()
+            servers = [s for s in servers if wanted in (s.country.lower(), s.country_code.lower())]
+        return servers
+
+    def visible(self, tier: SubscriptionTier) -> List[ProxyServer]:
+        return [s for s in self.servers.values() if tier == SubscriptionTier.PREMIUM or not s.is_premium]
+
+    def loads(self, tier: SubscriptionTier) -> Dict[str, int]:
+        """Current load per visible server; refresh() registers every server with the tracker"""
+        return {s.id: session_tracker.load_percentage(s.id) for s in self.visible(tier)}
+
+    def snapshot(self, tier: SubscriptionTier, known_version: Optional[str] = None) -> CatalogSnapshot:
+        """Full catalog for a tier, or only what changed since a version the client already has"""
+        version = self.tier_versions.get(tier, "")
+        if known_version == version:
+            return CatalogSnapshot(version=version, full=False)
+        previous = self.history.get(known_version) if known_version else None
+        if previous is None:
+            return CatalogSnapshot(version=version, servers=self.visible(tier))
+        current = self.history[version]
+        return CatalogSnapshot(
+            version=version,
+            full=False,
+            servers=[self.servers[server_id] for server_id, digest in current.items() if previous.get(server_id) != digest],
+            removed=[server_id for server_id in previous if server_id not in current]
+        )
+
+    async def run_refresh(self):
+        while True:
+            await asyncio.sleep(CATALOG_REFRESH_SECONDS)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Failed to refresh proxy catalog: {e}")
+
+proxy_catalog = ProxyCatalog()
+
+# WireGuard Config Rendering
+def generate_wireguard_keypair() -> tuple:
+    private_key = X25519PrivateKey.generate()
+    private_bytes = private_key.private_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PrivateFormat.Raw,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+    public_bytes = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw
+    )
+    return base64.b64encode(private_bytes).decode('ascii'), base64.b64encode(public_bytes).decode('ascii')
+
+class WireGuardKeyPool:
+    """Keypairs generated ahead of time so Curve25519 work stays off the request path"""
+
+    def __init__(self, size: int = WIREGUARD_KEY_POOL_SIZE, low_watermark: int = WIREGUARD_KEY_POOL_LOW_WATERMARK):
+        self.size = size
+        self.low_watermark = low_watermark
+        self.keys = deque()
+        self.needs_refill = asyncio.Event()
+
+    def take(self) -> tuple:
+        if len(self.keys) <= self.low_watermark:
+            self.needs_refill.set()
+        if self.keys:
+            return self.keys.popleft()
+        logger.warning("WireGuard key pool exhausted, generating keypair inline")
+        return generate_wireguard_keypair()
+
+    def _generate_batch(self, count: int) -> List[tuple]:
+        return [generate_wireguard_keypair() for _ in range(count)]
+
+    async def fill(self):
+        missing = self.size - len(self.keys)
+        if missing > 0:
+            self.keys.extend(await asyncio.to_thread(self._generate_batch, missing))
+
+    async def run_refill(self):
+        while True:
+            await self.needs_refill.wait()
+            self.needs_refill.clear()
+            try:
+                await self.fill()
+            except Exception as e:
+                logger.error(f"Failed to refill WireGuard key pool: {e}")
+
+wireguard_key_pool = WireGuardKeyPool()
+
+class WireGuardConfigCache:
+    """LRU cache of rendered client configs keyed by user and server"""
+
+    def __init__(self, max_size: int = WIREGUARD_CONFIG_CACHE_SIZE):
+        self.max_size = max_size
+        self.configs: OrderedDict = OrderedDict()
+
+    def get(self, user_id: str, proxy_id: str) -> Optional[bytes]:
+        key = (user_id, proxy_id)
+        config = self.configs.get(key)
+        if config is not None:
+            self.configs.move_to_end(key)
+        return config
+
+    def put(self, user_id: str, proxy_id: str, config: bytes):
+        self.configs[(user_id, proxy_id)] = config
+        self.configs.move_to_end((user_id, proxy_id))
+        while len(self.configs) > self.max_size:
+            self.configs.popitem(last=False)
+
+    def invalidate_proxy(self, proxy_id: str):
+        for key in [key for key in self.configs if key[1] == proxy_id]:
+            del self.configs[key]
+
+wireguard_config_cache = WireGuardConfigCache()
+
+def wireguard_client_address(sequence: int) -> str:
+    """Map a per-server allocation number (1, 2, ...) to a host address in the client network"""
+    # Offset 0 is the network address and offset 1 is the server's own tunnel address
+    offset = sequence + 1
+    if offset >= WIREGUARD_CLIENT_NETWORK.num_addresses - 1:
+        raise HTTPException(status_code=503, detail="No WireGuard addresses left on this server")
+    return f"{WIREGUARD_CLIENT_NETWORK.network_address + offset}/32"
+
+async def get_or_create_wireguard_peer(user_id: str, proxy_id: str) -> Dict[str, Any]:
+    """Return the user's persisted keypair and address on a server, allocating them once"""
+    query = {"user_id": user_id, "proxy_id": proxy_id}
+    peer = await db.wireguard_peers.find_one(query, {"_id": 0})
+    if peer:
+        return peer
+    
+    # A per-server counter hands out each address exactly once
+    counter = await db.wireguard_address_counters.find_one_and_update(
+        {"proxy_id": proxy_id},
+        {"$inc": {"next": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    private_key, public_key = wireguard_key_pool.take()
+    peer = {
+        "user_id": user_id,
+        "proxy_id": proxy_id,
+        "public_key": public_key,
+        "private_key": private_key,
+        "address": wireguard_client_address(counter["next"]),
+        "created_at": datetime.utcnow()
+    }
+    try:
+        await db.wireguard_peers.insert_one(dict(peer))
+    except DuplicateKeyError:
+        # A concurrent request for the same user and server inserted first
+        existing = await db.wireguard_peers.find_one(query, {"_id": 0})
+        if existing is None:
+            raise
+        return existing
+    return peer
+
+def wireguard_peer_allowed(user: Dict[str, Any], server: ProxyServer, now: datetime) -> bool:
+    """Whether a user's peer stays authorized on a node, re-checked on every sync"""
+    if not user.get("is_active", True):
+        return False
+    if not server.is_premium:
+        return True
+    expires_at = user.get("subscription_expires_at")
+    return user.get("subscription_tier") == SubscriptionTier.PREMIUM and (expires_at is None or expires_at > now)
+
+def render_wireguard_config(peer: Dict[str, Any], server: ProxyServer) -> bytes:
+    return (
+        "[Interface]\n"
+        f"PrivateKey = {peer['private_key']}\n"
+        f"Address = {peer['address']}\n"
+        f"DNS = {WIREGUARD_DNS}\n"
+        "\n"
+        "[Peer]\n"
+        f"PublicKey = {server.wireguard_public_key}\n"
+        f"Endpoint = {server.host}:{server.port}\n"
+        "AllowedIPs = 0.0.0.0/0, ::/0\n"
+        "PersistentKeepalive = 25\n"
+    ).encode('utf-8')
+
+# Usage Accounting
+class UsageRecorder:
+    """Buffers usage reports and writes them out in bulk.
+
+    Raw samples go to the usage_samples time-series collection, while hourly
+    and daily totals are folded into rollup collections with upserted $inc
+    so /api/usage never has to scan raw samples. Each flush's totals form a
+    batch with its own id; an upsert only applies if the document has not seen
+    that id, so a batch retried after a timeout is never counted twice.
+    """
+
+    def __init__(self):
+        self.buffer: deque = deque()
+        # (batch_id, {(user_id, proxy_id, bucket): [sent, received, seconds]}) waiting to be written
+        self.pending_rollups: Dict[UsageGranularity, List[tuple]] = {
+            granularity: [] for granularity in UsageGranularity
+        }
+        self.dropped = 0
+        self.dropped_rollup_batches = 0
+        self.flush_lock = asyncio.Lock()
+        self.early_flush: Optional[asyncio.Task] = None
+
+    def _trim(self):
+        # While Mongo is unreachable, keep the newest samples and drop the oldest
+        overflow = len(self.buffer) - USAGE_MAX_BUFFERED_SAMPLES
+        for _ in range(overflow):
+            self.buffer.popleft()
+        if overflow > 0:
+            self.dropped += overflow
+            logger.warning(f"Usage buffer full, dropped {overflow} samples ({self.dropped} total)")
+
+    def record(self, user_id: Optional[str], proxy_id: str, report: UsageReport) -> bool:
+        """Queue a sample and report whether the buffer is due for an early flush"""
+        self.buffer.append({
+            "timestamp": datetime.utcnow(),
+            "meta": {"user_id": user_id, "proxy_id": proxy_id},
+            "bytes_sent": report.bytes_sent,
+            "bytes_received": report.bytes_received,
+            "connected_seconds": report.connected_seconds
+        })
+        self._trim()
+        return len(self.buffer) >= USAGE_FLUSH_BATCH_SIZE
+
+    def schedule_flush(self):
+        # Hold a reference so the task is not garbage collected mid-flush
+        if self.early_flush is None or self.early_flush.done():
+            self.early_flush = asyncio.create_task(self.flush())
+
+    def _queue_rollups(self, granularity: UsageGranularity, batches: List[tuple]):
+        pending = self.pending_rollups[granularity]
+        pending.extend(batches)
+        overflow = len(pending) - USAGE_MAX_PENDING_ROLLUP_BATCHES
+        if overflow > 0:
+            del pending[:overflow]
+            self.dropped_rollup_batches += overflow
+            logger.warning(f"Too many pending {granularity.value} rollup batches, dropped {overflow} ({self.dropped_rollup_batches} total)")
+
+    def _fold(self, samples: List[Dict[str, Any]]):
+        """Add written samples to the pending hourly and daily totals"""
+        for granularity in UsageGranularity:
+            totals = defaultdict(lambda: [0, 0, 0])
+            for sample in samples:
+                if granularity == UsageGranularity.HOUR:
+                    bucket = sample["timestamp"].replace(minute=0, second=0, microsecond=0)
+                else:
+                    bucket = sample["timestamp"].replace(hour=0, minute=0, second=0, microsecond=0)
+                entry = totals[(sample["meta"]["user_id"], sample["meta"]["proxy_id"], bucket)]
+                entry[0] += sample["bytes_sent"]
+                entry[1] += sample["bytes_received"]
+                entry[2] += sample["connected_seconds"]
+            if totals:
+                self._queue_rollups(granularity, [(uuid.uuid4().hex, dict(totals))])
+
+    async def _write_samples(self, samples: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Insert raw samples and return the ones that were written; the rest are requeued"""
+        try:
+            # insert_many adds _id to each dict, so hand it copies
+            await db.usage_samples.insert_many([dict(sample) for sample in samples], ordered=False)
+            return samples
+        except BulkWriteError as e:
+            # Unordered inserts keep going past errors, so only the failed ones need a retry
+            failed = {error["index"] for error in e.details.get("writeErrors", [])}
+            logger.error(f"Failed to write {len(failed)} usage samples, will retry")
+        except Exception as e:
+            failed = set(range(len(samples)))
+            logger.error(f"Failed to write usage samples, will retry: {e}")
+        self.buffer.extendleft(reversed([sample for i, sample in enumerate(samples) if i in failed]))
+        self._trim()
+        return [sample for i, sample in enumerate(samples) if i not in failed]
+
+    async def _already_applied(self, granularity: UsageGranularity, batch_id: str, key: tuple) -> bool:
+        user_id, proxy_id, bucket = key
+        try:
+            doc = await usage_rollups(granularity).find_one(
+                {"user_id": user_id, "proxy_id": proxy_id, "bucket": bucket, "applied": batch_id},
+                {"_id": 1}
+            )
+        except Exception:
+            return False
+        return doc is not None
+
+    async def _write_rollups(self, granularity: UsageGranularity):
+        batches = self.pending_rollups[granularity]
+        if not batches:
+            return
+        self.pending_rollups[granularity] = []
+        entries = [(batch_id, key, amounts) for batch_id, totals in batches for key, amounts in totals.items()]
+        ops = [
+            UpdateOne(
+                {"user_id": user_id, "proxy_id": proxy_id, "bucket": bucket, "applied": {"$ne": batch_id}},
+                {
+                    "$inc": {"bytes_sent": sent, "bytes_received": received, "connected_seconds": seconds},
+                    "$push": {"applied": {"$each": [batch_id], "$slice": -USAGE_ROLLUP_APPLIED_HISTORY}}
+                },
+                upsert=True
+            )
+            for batch_id, (user_id, proxy_id, bucket), (sent, received, seconds) in entries
+        ]
+        try:
+            await usage_rollups(granularity).bulk_write(ops, ordered=False)
+            return
+        except BulkWriteError as e:
+            failed = []
+            for error in e.details.get("writeErrors", []):
+                batch_id, key, amounts = entries[error["index"]]
+                # A duplicate key means the guard did not match an existing document: either this
+                # batch already landed there, or another writer created the document first
+                if error.get("code") == 11000 and await self._already_applied(granularity, batch_id, key):
+                    continue
+                failed.append((batch_id, key, amounts))
+            if not failed:
+                return
+            logger.error(f"Failed to update {len(failed)} {granularity.value} usage rollups, will retry")
+        except Exception as e:
+            # The write may have landed before the error; the batch id guard makes the retry safe
+            failed = entries
+            logger.error(f"Failed to update {granularity.value} usage rollups, will retry: {e}")
+        retry = defaultdict(dict)
+        for batch_id, key, amounts in failed:
+            retry[batch_id][key] = amounts
+        self.pending_rollups[granularity] = list(retry.items()) + self.pending_rollups[granularity]
+
+    async def flush(self):
+        async with self.flush_lock:
+            if self.buffer:
+                samples = list(self.buffer)
+                self.buffer.clear()
+                self._fold(await self._write_samples(samples))
+            await asyncio.gather(*(self._write_rollups(granularity) for granularity in UsageGranularity))
+
+    async def run_flush(self):
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_SECONDS)
+            await self.flush()
+
+usage_recorder = UsageRecorder()
+
+def usage_rollups(granularity: UsageGranularity):
+    return db.usage_rollups_hourly if granularity == UsageGranularity.HOUR else db.usage_rollups_daily
+
+async def ensure_usage_collections():
+    try:
+        await db.create_collection(
+            "usage_samples",
+            timeseries={"timeField": "timestamp", "metaField": "meta", "granularity": "minutes"},
+            expireAfterSeconds=USAGE_SAMPLE_RETENTION_DAYS * 24 * 3600
+        )
+    except CollectionInvalid:
+        pass
+    for granularity in UsageGranularity:
+        await usage_rollups(granularity).create_index(
+            [("user_id", ASCENDING), ("bucket", ASCENDING), ("proxy_id", ASCENDING)],
+            unique=True
+        )
+
+async def ensure_indexes():
+    """Indexes backing every lookup the routes make; tests/test_query_plans.py enforces them"""
+    await db.users.create_index("email", unique=True)
+    await db.users.create_index("id", unique=True)
+    await db.proxy_servers.create_index("id", unique=True)
+    await db.proxy_servers.create_index("is_premium")
+    await db.wireguard_peers.create_index([("user_id", ASCENDING), ("proxy_id", ASCENDING)], unique=True)
+    await db.wireguard_peers.create_index([("proxy_id", ASCENDING), ("address", ASCENDING)], unique=True)
+    await db.wireguard_address_counters.create_index("proxy_id", unique=True)
+
+def recommend_server(tier: SubscriptionTier, country: Optional[str] = None) -> Optional[ProxyServer]:
+    """Least loaded reachable server for the tier, preferring the requested country"""
+    candidates = [s for s in proxy_catalog.visible(tier) if s.is_online and session_tracker.active_counts.get(s.id, 0) < s.capacity]
+    if country:
+        wanted = country.strip().lower()
+        local = [s for s in candidates if wanted in (s.country.lower(), s.country_code.lower())]
+        candidates = local or candidates
+    if not candidates:
+        return None
+    server = min(candidates, key=lambda s: (session_tracker.load_fraction(s.id, s.capacity), s.ping_ms))
+    return server.copy(update={"load_percentage": session_tracker.load_percentage(server.id)})
+
+def pick_server(candidates: List[ProxyServer]) -> Optional[ProxyServer]:
+    """Power-of-two-choices: sample two servers with spare capacity and keep the less loaded one"""
+    eligible = [s for s in candidates if session_tracker.active_counts.get(s.id, 0) < s.capacity]
+    if len(eligible) <= 1:
+        return eligible[0] if eligible else None
+    first, second = random.sample(eligible, 2)
+    if session_tracker.load_fraction(second.id, second.capacity) < session_tracker.load_fraction(first.id, first.capacity):
+        return second
+    return first
+
+async def flush_server_loads():
+    """Periodically write aggregated session counts into proxy_servers.load_percentage"""
+    while True:
+        await asyncio.sleep(SERVER_LOAD_FLUSH_SECONDS)
+        loads = session_tracker.drain_dirty()
+        if not loads:
+            continue
+        try:
+            await db.proxy_servers.bulk_write(
+                [UpdateOne({"id": proxy_id}, {"$set": {"load_percentage": load}}) for proxy_id, load in loads.items()],
+                ordered=False
+            )
+        except Exception as e:
+            logger.error(f"Failed to flush server loads: {e}")
+            session_tracker.dirty.update(loads)
+
 # Authentication Routes
 @api_router.post("/auth/register", response_model=AuthResponse)
 async def register(user_data: UserRegister):
@@ -141,9 +1281,11 @@ async def register(user_data: UserRegister):
         raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create new user
+    with trace_span("bcrypt.hashpw", rounds=bcrypt_rounds):
+        password_hash = await asyncio.to_thread(hash_password, user_data.password)
     user = User(
         email=user_data.email,
-        password_hash=hash_password(user_data.password)
+        password_hash=password_hash
     )
     
     await db.users.insert_one(user.dict())
@@ -161,11 +1303,21 @@ async def register(user_data: UserRegister):
 async def login(user_data: UserLogin):
     # Find user
     user_doc = await db.users.find_one({"email": user_data.email})
-    if not user_doc or not verify_password(user_data.password, user_doc["password_hash"]):
+    if not user_doc:
+        raise HTTPException(status_code=401, detail="Invalid email or password")
+    with trace_span("bcrypt.checkpw", rounds=bcrypt_cost(user_doc["password_hash"])):
+        password_ok = await asyncio.to_thread(verify_password, user_data.password, user_doc["password_hash"])
+    if not password_ok:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     user = User(**user_doc)
     
+    # Upgrade hashes made with an older cost factor without delaying the response
+    if bcrypt_cost(user.password_hash) < bcrypt_rounds:
+        task = asyncio.create_task(rehash_password(user.id, user_data.password, user.password_hash))
+        pending_rehashes.add(task)
+        task.add_done_callback(pending_rehashes.discard)
+    
     # Update last login
     await db.users.update_one(
         {"id": user.id},
@@ -223,12 +1375,128 @@ async def get_proxies(current_user: Optional[User] = Depends(get_current_user)):
     return [ProxyServer(**proxy) for proxy in proxies]
 
 # Guest/Anonymous Routes
-@api_router.get("/proxies/guest", response_model=List[ProxyServer])
-async def get_guest_proxies():
+@api_router.get("/proxies/guest", response_model=List[ProxyCatalogEntry])
+async def get_guest_proxies(request: Request):
     """Get free proxies for guest users without authentication"""
-    query = {"is_premium": False}
-    proxies = await db.proxy_servers.find(query).to_list(1000)
-    return [ProxyServer(**proxy) for proxy in proxies]
+    # Served from the in-memory catalog so edge caches and revalidations never reach Mongo
+    payload = proxy_catalog.guest_payload
+    encoding = payload.negotiate(request.headers.get("accept-encoding", ""))
+    headers = {
+        "ETag": payload.etag(encoding),
+        "Cache-Control": f"public, max-age={GUEST_CATALOG_MAX_AGE_SECONDS}, stale-while-revalidate={GUEST_CATALOG_STALE_WHILE_REVALIDATE_SECONDS}",
+        "Vary": "Accept-Encoding",
+    }
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and payload.matches(if_none_match):
+        return Response(status_code=304, headers=headers)
+    
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=payload.encoded[encoding], media_type="application/json", headers=headers)
+
+@api_router.get("/proxies/load", response_model=Dict[str, int])
+async def get_proxy_loads(response: Response, tier: SubscriptionTier = Depends(get_token_tier)):
+    """Live load per server, kept out of the catalog so catalog ETags only change with the servers"""
+    scope = "public" if tier == SubscriptionTier.FREE else "private"
+    response.headers["Cache-Control"] = f"{scope}, max-age={PROXY_LOAD_MAX_AGE_SECONDS}"
+    response.headers["Vary"] = "Authorization"
+    return proxy_catalog.loads(tier)
+
+@api_router.post("/proxies/assign", response_model=ProxyAssignment)
+async def assign_proxy(assign_request: ProxyAssignRequest, tier: SubscriptionTier = Depends(get_token_tier)):
+    """Pick a concrete server for a country or city from in-memory catalog and load state"""
+    candidates = [
+        s for s in proxy_catalog.find(assign_request.country, assign_request.city)
+        if s.is_online and (tier == SubscriptionTier.PREMIUM or not s.is_premium)
+    ]
+    if not candidates:
+        raise HTTPException(status_code=404, detail="No proxy servers available for this location")
+    
+    # Nothing between picking and reserving awaits, so the capacity check cannot race
+    server = pick_server(candidates)
+    reservation_id = session_tracker.reserve(server.id, server.capacity) if server else None
+    if reservation_id is None:
+        raise HTTPException(status_code=503, detail="All proxy servers for this location are at capacity")
+    
+    return ProxyAssignment(
+        server=server.copy(update={"load_percentage": session_tracker.load_percentage(server.id)}),
+        reservation_id=reservation_id
+    )
+
+@api_router.get("/proxies/{proxy_id}/config")
+async def get_proxy_config(proxy_id: str, current_user: User = Depends(get_current_user)):
+    """Return a ready-to-import WireGuard client config for this user and server"""
+    server = proxy_catalog.servers.get(proxy_id)
+    if server is None:
+        raise HTTPException(status_code=404, detail="Proxy server not found")
+    
+    if server.is_premium and current_user.subscription_tier == SubscriptionTier.FREE:
+        raise HTTPException(status_code=403, detail="Premium subscription required")
+    
+    if server.proxy_type != ProxyType.WIREGUARD:
+        raise HTTPException(status_code=400, detail="Proxy server does not support WireGuard configs")
+    
+    if not server.wireguard_public_key:
+        # Set by the node itself through PUT /proxies/{proxy_id}/wireguard-key
+        raise HTTPException(status_code=503, detail="WireGuard server key has not been registered yet")
+    
+    config = wireguard_config_cache.get(current_user.id, server.id)
+    if config is None:
+        peer = await get_or_create_wireguard_peer(current_user.id, server.id)
+        config = render_wireguard_config(peer, server)
+        wireguard_config_cache.put(current_user.id, server.id, config)
+    
+    return Response(
+        content=config,
+        media_type="text/plain",
+        headers={
+            "Content-Disposition": f'attachment; filename="{server.country_code.lower()}-{server.city.lower().replace(" ", "-")}.conf"',
+            # The config carries the client's private key
+            "Cache-Control": "no-store"
+        }
+    )
+
+@api_router.get("/proxies/{proxy_id}/peers", response_model=List[WireGuardPeer], dependencies=[Depends(verify_node_token)])
+async def get_proxy_peers(proxy_id: str):
+    """Peer list a WireGuard node pulls to keep its interface in sync (e.g. via wg syncconf).
+
+    Peers are filtered by the owner's current entitlement, so a downgrade, expiry
+    or deactivation drops the key from the node on its next sync.
+    """
+    server = proxy_catalog.servers.get(proxy_id)
+    if server is None:
+        raise HTTPException(status_code=404, detail="Proxy server not found")
+    
+    peers = await db.wireguard_peers.find(
+        {"proxy_id": proxy_id},
+        {"_id": 0, "user_id": 1, "public_key": 1, "address": 1}
+    ).to_list(None)
+    users = await db.users.find(
+        {"id": {"$in": list({peer["user_id"] for peer in peers})}},
+        {"_id": 0, "id": 1, "is_active": 1, "subscription_tier": 1, "subscription_expires_at": 1}
+    ).to_list(None)
+    now = datetime.utcnow()
+    allowed = {user["id"] for user in users if wireguard_peer_allowed(user, server, now)}
+    return [
+        WireGuardPeer(public_key=peer["public_key"], allowed_ips=peer["address"])
+        for peer in peers if peer["user_id"] in allowed
+    ]
+
+@api_router.put("/proxies/{proxy_id}/wireguard-key", response_model=ProxyServer, dependencies=[Depends(verify_node_token)])
+async def register_wireguard_key(proxy_id: str, key: WireGuardServerKey):
+    """Called by a WireGuard node with its own public key; the private key never leaves the node"""
+    proxy = await db.proxy_servers.find_one_and_update(
+        {"id": proxy_id, "proxy_type": ProxyType.WIREGUARD},
+        {"$set": {"wireguard_public_key": key.public_key}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not proxy:
+        raise HTTPException(status_code=404, detail="WireGuard proxy server not found")
+    
+    # Refreshing also drops cached client configs rendered with the previous key
+    await proxy_catalog.refresh()
+    return ProxyServer(**proxy)
 
 @api_router.get("/proxies/{proxy_id}", response_model=ProxyServer)
 async def get_proxy(proxy_id: str, current_user: User = Depends(get_current_user)):
@@ -244,6 +1512,142 @@ async def get_proxy(proxy_id: str, current_user: User = Depends(get_current_user
     
     return proxy_obj
 
+# Session Routes
+@api_router.post("/sessions/start", response_model=SessionInfo)
+async def start_session(session_data: SessionStart, current_user: Optional[User] = Depends(get_optional_user)):
+    proxy = await db.proxy_servers.find_one({"id": session_data.proxy_id})
+    if not proxy:
+        raise HTTPException(status_code=404, detail="Proxy server not found")
+    
+    proxy_obj = ProxyServer(**proxy)
+    if not proxy_obj.is_online:
+        raise HTTPException(status_code=503, detail="Proxy server is offline")
+    
+    # Guests and free users can only connect to free proxies
+    if proxy_obj.is_premium and (current_user is None or current_user.subscription_tier == SubscriptionTier.FREE):
+        raise HTTPException(status_code=403, detail="Premium subscription required")
+    
+    user_id = current_user.id if current_user else None
+    
+    # Reuse the capacity reserved by /proxies/assign when the client still holds it
+    if session_data.reservation_id and session_tracker.claim(session_data.reservation_id, proxy_obj.id, user_id):
+        return SessionInfo(session_id=session_data.reservation_id, proxy_id=proxy_obj.id)
+    
+    session_id = session_tracker.try_start(proxy_obj.id, user_id, proxy_obj.capacity)
+    if session_id is None:
+        raise HTTPException(status_code=503, detail="Proxy server is at capacity")
+    return SessionInfo(session_id=session_id, proxy_id=proxy_obj.id)
+
+@api_router.post("/sessions/{session_id}/heartbeat", response_model=SessionInfo)
+async def session_heartbeat(session_id: str):
+    # The session id is an unguessable token, so heartbeats skip auth and Mongo entirely
+    session = session_tracker.heartbeat(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return SessionInfo(session_id=session_id, proxy_id=session.proxy_id)
+
+@api_router.post("/sessions/{session_id}/stop")
+async def stop_session(session_id: str):
+    # Stopping is idempotent so clients can retry on flaky networks
+    session_tracker.stop(session_id)
+    return {"message": "Session stopped"}
+
+# Usage Routes
+@api_router.post("/usage/report")
+async def report_usage(report: UsageReport):
+    # Like heartbeats, reports are authenticated by the session token alone
+    session = session_tracker.sessions.get(report.session_id)
+    if session is None or session.pending:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    
+    if usage_recorder.record(session.user_id, session.proxy_id, report):
+        usage_recorder.schedule_flush()
+    
+    return {"status": "accepted"}
+
+@api_router.get("/usage", response_model=UsageSummary)
+async def get_usage(
+    granularity: UsageGranularity = UsageGranularity.DAY,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Return precomputed usage rollups for the current user"""
+    if start is None:
+        start = datetime.utcnow() - (timedelta(days=1) if granularity == UsageGranularity.HOUR else timedelta(days=30))
+    
+    bucket_range = {"$gte": start}
+    if end is not None:
+        bucket_range["$lt"] = end
+    
+    docs = await usage_rollups(granularity).find(
+        {"user_id": current_user.id, "bucket": bucket_range},
+        {"_id": 0, "user_id": 0, "applied": 0}
+    ).sort("bucket", ASCENDING).to_list(None)
+    buckets = [UsageBucket(**doc) for doc in docs]
+    
+    return UsageSummary(
+        granularity=granularity,
+        buckets=buckets,
+        total_bytes_sent=sum(b.bytes_sent for b in buckets),
+        total_bytes_received=sum(b.bytes_received for b in buckets),
+        total_connected_seconds=sum(b.connected_seconds for b in buckets)
+    )
+
+# Bootstrap
+async def build_subscription_state(user: Optional[User]) -> SubscriptionState:
+    if user is None:
+        return SubscriptionState(tier=SubscriptionTier.FREE, is_active=False)
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    try:
+        usage = await db.usage_rollups_daily.find(
+            {"user_id": user.id, "bucket": today},
+            {"_id": 0, "bytes_sent": 1, "bytes_received": 1}
+        ).to_list(None)
+        usage_today_bytes = sum(doc.get("bytes_sent", 0) + doc.get("bytes_received", 0) for doc in usage)
+    except Exception as e:
+        # Usage is informational, so a rollup failure must not fail the whole bootstrap
+        logger.error(f"Failed to load usage for bootstrap: {e}")
+        usage_today_bytes = None
+    is_active = user.subscription_tier == SubscriptionTier.PREMIUM and (
+        user.subscription_expires_at is None or user.subscription_expires_at > datetime.utcnow()
+    )
+    return SubscriptionState(
+        tier=user.subscription_tier,
+        expires_at=user.subscription_expires_at,
+        is_active=is_active,
+        usage_today_bytes=usage_today_bytes
+    )
+
+@api_router.get("/bootstrap", response_model=BootstrapResponse)
+async def bootstrap(
+    catalog_version: Optional[str] = None,
+    country: Optional[str] = None,
+    current_user: Optional[User] = Depends(get_optional_user)
+):
+    """Everything the app needs at launch in one round trip, for guests and signed-in users"""
+    tier = current_user.subscription_tier if current_user else SubscriptionTier.FREE
+    # Catalog and recommendation come from memory; only the subscription state touches Mongo
+    subscription = await build_subscription_state(current_user)
+    
+    profile = None
+    if current_user:
+        profile = UserProfile(
+            id=current_user.id,
+            email=current_user.email,
+            subscription_tier=current_user.subscription_tier,
+            subscription_expires_at=current_user.subscription_expires_at,
+            created_at=current_user.created_at
+        )
+    
+    return BootstrapResponse(
+        profile=profile,
+        subscription=subscription,
+        catalog=proxy_catalog.snapshot(tier, catalog_version),
+        recommended_server=recommend_server(tier, country),
+        loads=proxy_catalog.loads(tier)
+    )
+
 # Subscription Management
 @api_router.post("/subscription/upgrade")
 async def upgrade_subscription(current_user: User = Depends(get_current_user)):
@@ -259,7 +1663,12 @@ async def upgrade_subscription(current_user: User = Depends(get_current_user)):
         }
     )
     
-    return {"message": "Subscription upgraded successfully"}
+    # Reissue the token so JWT-only checks like /proxies/assign see the new tier right away
+    return {
+        "message": "Subscription upgraded successfully",
+        "access_token": create_access_token(current_user.id, SubscriptionTier.PREMIUM),
+        "subscription_tier": SubscriptionTier.PREMIUM
+    }
 
 # RevenueCat Webhook (placeholder)
 @api_router.post("/webhooks/revenuecat")
@@ -299,6 +1708,10 @@ logger = logging.getLogger(__name__)
 @app.on_event("startup")
 async def startup_event():
     """Initialize database with sample data if needed"""
+    global bcrypt_rounds
+    bcrypt_rounds = await asyncio.to_thread(calibrate_bcrypt_rounds)
+    logger.info(f"Using bcrypt cost {bcrypt_rounds} for a {BCRYPT_TARGET_HASH_MS:.0f}ms target")
+    
     # Create sample proxy servers
     proxy_count = await db.proxy_servers.count_documents({})
     if proxy_count == 0:
@@ -316,6 +1729,7 @@ async def startup_event():
                 "is_online": True,
                 "load_percentage": 45,
                 "ping_ms": 25,
+                "capacity": DEFAULT_SERVER_CAPACITY,
                 "created_at": datetime.utcnow()
             },
             {
@@ -331,6 +1745,7 @@ async def startup_event():
                 "is_online": True,
                 "load_percentage": 20,
                 "ping_ms": 15,
+                "capacity": DEFAULT_SERVER_CAPACITY,
                 "created_at": datetime.utcnow()
             },
             {
@@ -346,6 +1761,7 @@ async def startup_event():
                 "is_online": True,
                 "load_percentage": 35,
                 "ping_ms": 30,
+                "capacity": DEFAULT_SERVER_CAPACITY,
                 "created_at": datetime.utcnow()
             },
             {
@@ -361,13 +1777,31 @@ async def startup_event():
                 "is_online": True,
                 "load_percentage": 60,
                 "ping_ms": 80,
+                "capacity": DEFAULT_SERVER_CAPACITY,
                 "created_at": datetime.utcnow()
             }
         ]
         
         await db.proxy_servers.insert_many(sample_proxies)
         logger.info("Sample proxy servers created")
+    
+    await proxy_catalog.refresh()
+    await wireguard_key_pool.fill()
+    await ensure_indexes()
+    await ensure_usage_collections()
+    
+    # Start session expiry, load flushing, catalog refresh, key pool refill and usage flushing
+    app.state.background_tasks = [
+        asyncio.create_task(session_tracker.run_expiry()),
+        asyncio.create_task(flush_server_loads()),
+        asyncio.create_task(proxy_catalog.run_refresh()),
+        asyncio.create_task(wireguard_key_pool.run_refill()),
+        asyncio.create_task(usage_recorder.run_flush()),
+    ]
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in getattr(app.state, "background_tasks", []):
+        task.cancel()
+    await usage_recorder.flush()
     client.close()
\ No newline at end of file
@@ -1,6 +1,7 @@
 import { create } from 'zustand';
 import AsyncStorage from '@react-native-async-storage/async-storage';
 import axios from 'axios';
+import { useVPNStore } from './vpnStore';
 
 const API_BASE_URL = process.env.EXPO_PUBLIC_BACKEND_URL + '/api';
 
@@ -148,9 +149,12 @@ export const useAuthStore = create<AuthState>((set, get) => ({
       // Set axios header
       axios.defaults.headers.common['Authorization'] = `Bearer ${token}`;
 
-      // Fetch user profile
-      const response = await axios.get(`${API_BASE_URL}/auth/profile`);
-      const userData = response.data;
+      // Fetch profile, subscription and server catalog in a single round trip
+      const catalogVersion = await useVPNStore.getState().loadCachedCatalog();
+      const response = await axios.get(`${API_BASE_URL}/bootstrap`, {
+        params: catalogVersion ? { catalog_version: catalogVersion } : {},
+      });
+      const userData = response.data.profile;
 
       const user: User = {
         id: userData.id,
@@ -165,8 +169,21 @@ export const useAuthStore = create<AuthState>((set, get) => ({
         isAuthenticated: true,
         isLoading: false,
       });
+
+      // A catalog problem must not sign the user out
+      try {
+        await useVPNStore.getState().applyBootstrap(response.data);
+      } catch (error) {
+        console.error('Failed to apply server catalog:', error);
+      }
     } catch (error) {
-      // Token is invalid, clear it
+      // Keep the token through network or server errors; only a 401 means it is invalid
+      if (!axios.isAxiosError(error) || error.response?.status !== 401) {
+        console.error('Failed to load user:', error);
+        set({ isLoading: false });
+        return;
+      }
+
       await AsyncStorage.removeItem('auth_token');
       delete axios.defaults.headers.common['Authorization'];
       
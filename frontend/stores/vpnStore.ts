@@ -1,7 +1,10 @@
 import { create } from 'zustand';
 import axios from 'axios';
+import AsyncStorage from '@react-native-async-storage/async-storage';
 
 const API_BASE_URL = process.env.EXPO_PUBLIC_BACKEND_URL + '/api';
+const GUEST_CATALOG_KEY = 'guest_catalog';
+const CATALOG_KEY = 'catalog';
 
 interface ProxyServer {
   id: string;
@@ -18,52 +21,117 @@ interface ProxyServer {
   ping_ms: number;
 }
 
+interface CatalogSnapshot {
+  version: string;
+  full: boolean;
+  servers: ProxyServer[];
+  removed: string[];
+}
+
+interface BootstrapData {
+  catalog: CatalogSnapshot;
+  recommended_server: ProxyServer | null;
+  loads: Record<string, number>;
+}
+
 type ConnectionStatus = 'disconnected' | 'connecting' | 'connected' | 'disconnecting';
 
 interface VPNState {
   isConnected: boolean;
   connectionStatus: ConnectionStatus;
+  sessionId: string | null;
   selectedServer: ProxyServer | null;
   servers: ProxyServer[];
   isLoadingServers: boolean;
-  connect: () => void;
-  disconnect: () => void;
+  connect: () => Promise<void>;
+  disconnect: () => Promise<void>;
   selectServer: (server: ProxyServer) => void;
   fetchServers: () => Promise<void>;
+  loadCachedCatalog: () => Promise<string | null>;
+  applyBootstrap: (data: BootstrapData) => Promise<void>;
 }
 
+let heartbeatTimer: ReturnType<typeof setInterval> | null = null;
+
+// Load is served apart from the cacheable catalog, which leaves it out
+const withLoads = (servers: ProxyServer[], loads: Record<string, number>) =>
+  servers.map((server) => ({ ...server, load_percentage: loads[server.id] ?? server.load_percentage ?? 0 }));
+
+const stopHeartbeat = () => {
+  if (heartbeatTimer) {
+    clearInterval(heartbeatTimer);
+    heartbeatTimer = null;
+  }
+};
+
 export const useVPNStore = create<VPNState>((set, get) => ({
   isConnected: false,
   connectionStatus: 'disconnected',
+  sessionId: null,
   selectedServer: null,
   servers: [],
   isLoadingServers: false,
 
-  connect: () => {
+  connect: async () => {
     const { selectedServer } = get();
     if (!selectedServer) return;
 
     set({ connectionStatus: 'connecting' });
-    
-    // Simulate connection process
-    setTimeout(() => {
-      set({ 
-        isConnected: true, 
-        connectionStatus: 'connected' 
+
+    try {
+      const response = await axios.post(`${API_BASE_URL}/sessions/start`, {
+        proxy_id: selectedServer.id,
+      });
+      const { session_id, heartbeat_interval } = response.data;
+
+      set({
+        isConnected: true,
+        connectionStatus: 'connected',
+        sessionId: session_id,
       });
-    }, 2000);
+
+      // Keep the session alive so the server counts us towards its load
+      stopHeartbeat();
+      heartbeatTimer = setInterval(async () => {
+        try {
+          await axios.post(`${API_BASE_URL}/sessions/${session_id}/heartbeat`);
+        } catch (error) {
+          console.error('Session heartbeat failed:', error);
+          // The server allows a few missed heartbeats, so only a 404 means the session is gone
+          if (!axios.isAxiosError(error) || error.response?.status !== 404) return;
+          stopHeartbeat();
+          set({
+            isConnected: false,
+            connectionStatus: 'disconnected',
+            sessionId: null,
+          });
+        }
+      }, heartbeat_interval * 1000);
+    } catch (error) {
+      console.error('Failed to start session:', error);
+      set({ connectionStatus: 'disconnected' });
+    }
   },
 
-  disconnect: () => {
+  disconnect: async () => {
+    const { sessionId } = get();
     set({ connectionStatus: 'disconnecting' });
-    
-    // Simulate disconnection process
-    setTimeout(() => {
-      set({ 
-        isConnected: false, 
-        connectionStatus: 'disconnected' 
-      });
-    }, 1000);
+    stopHeartbeat();
+
+    try {
+      if (sessionId) {
+        await axios.post(`${API_BASE_URL}/sessions/${sessionId}/stop`);
+      }
+    } catch (error) {
+      // The server expires sessions without heartbeats, so this is safe to ignore
+      console.error('Failed to stop session:', error);
+    }
+
+    set({
+      isConnected: false,
+      connectionStatus: 'disconnected',
+      sessionId: null,
+    });
   },
 
   selectServer: (server: ProxyServer) => {
@@ -75,16 +143,40 @@ export const useVPNStore = create<VPNState>((set, get) => ({
       set({ isLoadingServers: true });
       
       // Try guest endpoint first (no auth required), then fall back to authenticated endpoint
-      let response;
+      let servers;
       try {
-        response = await axios.get(`${API_BASE_URL}/proxies/guest`);
+        // Revalidate the cached guest catalog instead of downloading it again
+        const cached = JSON.parse((await AsyncStorage.getItem(GUEST_CATALOG_KEY)) || 'null');
+        const response = await axios.get(`${API_BASE_URL}/proxies/guest`, {
+          headers: cached ? { 'If-None-Match': cached.etag } : {},
+          validateStatus: (status) => status === 200 || status === 304,
+        });
+
+        if (response.status === 304 && cached) {
+          servers = cached.servers;
+        } else {
+          servers = response.data;
+          if (response.headers.etag) {
+            await AsyncStorage.setItem(
+              GUEST_CATALOG_KEY,
+              JSON.stringify({ etag: response.headers.etag, servers })
+            );
+          }
+        }
+
+        try {
+          const loads = await axios.get(`${API_BASE_URL}/proxies/load`);
+          servers = withLoads(servers, loads.data);
+        } catch (error) {
+          console.error('Failed to fetch server load:', error);
+          servers = withLoads(servers, {});
+        }
       } catch (error) {
         // If guest endpoint fails, try authenticated endpoint
-        response = await axios.get(`${API_BASE_URL}/proxies`);
+        const response = await axios.get(`${API_BASE_URL}/proxies`);
+        servers = response.data;
       }
       
-      const servers = response.data;
-      
       set({ 
         servers,
         isLoadingServers: false 
@@ -100,4 +192,43 @@ export const useVPNStore = create<VPNState>((set, get) => ({
       set({ isLoadingServers: false });
     }
   },
+
+  loadCachedCatalog: async () => {
+    const cached = JSON.parse((await AsyncStorage.getItem(CATALOG_KEY)) || 'null');
+    if (!cached) return null;
+
+    set({ servers: cached.servers });
+    return cached.version;
+  },
+
+  applyBootstrap: async ({ catalog, recommended_server, loads }: BootstrapData) => {
+    let servers = catalog.servers;
+
+    // A non-full catalog is a delta against the version we sent from the cache
+    if (!catalog.full) {
+      const cached = JSON.parse((await AsyncStorage.getItem(CATALOG_KEY)) || 'null');
+      const changed = new Map(catalog.servers.map((server) => [server.id, server]));
+      const removed = new Set(catalog.removed);
+      const base: ProxyServer[] = cached ? cached.servers : [];
+
+      servers = base
+        .filter((server) => !removed.has(server.id))
+        .map((server) => changed.get(server.id) ?? server);
+      const known = new Set(base.map((server) => server.id));
+      servers.push(...catalog.servers.filter((server) => !known.has(server.id)));
+    }
+
+    await AsyncStorage.setItem(
+      CATALOG_KEY,
+      JSON.stringify({ version: catalog.version, servers })
+    );
+
+    servers = withLoads(servers, loads ?? {});
+    set({ servers });
+
+    const { selectedServer } = get();
+    if (!selectedServer) {
+      set({ selectedServer: recommended_server ?? servers[0] ?? null });
+    }
+  },
 }));
\ No newline at end of file
@@ -0,0 +1,24 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+
+@pytest.fixture(scope="session")
+def server():
+    """Import backend/server.py without leaking its required environment into the session.
+
+    Motor connects lazily, so a placeholder URL is enough for tests that only
+    exercise in-memory state.
+    """
+    pytest.importorskip("fastapi")
+    pytest.importorskip("motor")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("MONGO_URL", os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+        mp.setenv("DB_NAME", os.environ.get("DB_NAME", "vpn_test"))
+        mp.syspath_prepend(str(BACKEND_DIR))
+        import server as server_module
+    return server_module
@@ -0,0 +1,198 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return [dict(doc) for doc in self.docs]
+
+
+class FakeProxyServers:
+    def __init__(self):
+        self.docs = []
+
+    def find(self, query):
+        return FakeCursor(self.docs)
+
+
+class FailingRollups:
+    def find(self, query, projection=None):
+        raise ConnectionError("rollups unavailable")
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.proxy_servers = FakeProxyServers()
+        self.usage_rollups_daily = FailingRollups()
+
+
+def proxy_doc(server, name, **fields):
+    return server.ProxyServer(
+        name=name, country="Germany", country_code="DE", city="Berlin",
+        proxy_type="https", host=f"{name}.nvpn.com", port=443, **fields
+    ).dict()
+
+
+@pytest.fixture
+def fake_db(server, monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "db", database)
+    return database
+
+
+@pytest.fixture
+def catalog(server, monkeypatch):
+    catalog = server.ProxyCatalog()
+    monkeypatch.setattr(server, "proxy_catalog", catalog)
+    monkeypatch.setattr(server, "session_tracker", server.SessionTracker())
+    return catalog
+
+
+def test_negotiate_prefers_compressed_and_honours_q_zero(server):
+    payload = server.CachedPayload(b'[{"id":"a"}]')
+    assert payload.negotiate("gzip, deflate") == "gzip"
+    assert payload.negotiate("gzip;q=0, identity") == "identity"
+    assert payload.negotiate("") == "identity"
+    assert payload.negotiate("*") in payload.encoded
+
+
+def test_matches_is_weak_and_covers_every_coding(server):
+    payload = server.CachedPayload(b"[]")
+    assert payload.matches(payload.etag("identity"))
+    assert payload.matches(f'W/{payload.etag("gzip")}')
+    assert payload.matches(f'"other", {payload.etag("gzip")}')
+    assert payload.matches("*")
+    assert not payload.matches('"other"')
+
+
+def test_guest_version_ignores_load_changes(server, fake_db, catalog):
+    fake_db.proxy_servers.docs = [proxy_doc(server, "a", load_percentage=10), proxy_doc(server, "b", load_percentage=50)]
+    asyncio.run(catalog.refresh())
+    version = catalog.guest_payload.version
+    assert all("load_percentage" not in entry for entry in json.loads(catalog.guest_payload.body))
+
+    fake_db.proxy_servers.docs[0]["load_percentage"] = 90
+    asyncio.run(catalog.refresh())
+    assert catalog.guest_payload.version == version
+
+    fake_db.proxy_servers.docs[0]["ping_ms"] = 40
+    asyncio.run(catalog.refresh())
+    assert catalog.guest_payload.version != version
+
+
+def test_guest_route_serves_gzip_and_304(server, fake_db, catalog):
+    from fastapi.testclient import TestClient
+
+    fake_db.proxy_servers.docs = [proxy_doc(server, "a"), proxy_doc(server, "premium", is_premium=True)]
+    asyncio.run(catalog.refresh())
+    client = TestClient(server.app)
+
+    response = client.get("/api/proxies/guest", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["etag"] == catalog.guest_payload.etag("gzip")
+    assert [entry["name"] for entry in response.json()] == ["a"]
+    assert gzip.decompress(catalog.guest_payload.encoded["gzip"]) == catalog.guest_payload.body
+
+    revalidated = client.get("/api/proxies/guest", headers={"If-None-Match": response.headers["etag"]})
+    assert revalidated.status_code == 304
+    assert revalidated.content == b""
+
+
+def test_load_route_reads_tracker_not_stored_load(server, fake_db, catalog):
+    from fastapi.testclient import TestClient
+
+    tracker = server.session_tracker
+    live, stale = proxy_doc(server, "live", capacity=4), proxy_doc(server, "stale", load_percentage=30)
+    fake_db.proxy_servers.docs = [live, stale, proxy_doc(server, "premium", is_premium=True)]
+    asyncio.run(catalog.refresh())
+    tracker.start(live["id"], None, 4)
+
+    response = TestClient(server.app).get("/api/proxies/load")
+    assert response.status_code == 200
+    assert response.json() == {live["id"]: 25, stale["id"]: 0}
+    assert response.headers["cache-control"] == f"public, max-age={server.PROXY_LOAD_MAX_AGE_SECONDS}"
+
+
+def test_refresh_schedules_flush_of_stale_stored_load(server, fake_db, catalog):
+    stale = proxy_doc(server, "stale", load_percentage=45, capacity=8)
+    fake_db.proxy_servers.docs = [stale]
+    asyncio.run(catalog.refresh())
+
+    assert server.session_tracker.capacities[stale["id"]] == 8
+    assert server.session_tracker.drain_dirty() == {stale["id"]: 0}
+    asyncio.run(catalog.refresh())
+    assert server.session_tracker.drain_dirty() == {}
+
+
+def test_snapshot_sends_only_changed_and_removed_servers(server, fake_db, catalog):
+    a, b, c = proxy_doc(server, "a"), proxy_doc(server, "b"), proxy_doc(server, "c")
+    fake_db.proxy_servers.docs = [a, b, c]
+    asyncio.run(catalog.refresh())
+    known = catalog.tier_versions[server.SubscriptionTier.FREE]
+    assert catalog.snapshot(server.SubscriptionTier.FREE, known).servers == []
+
+    b["ping_ms"] = 80
+    fake_db.proxy_servers.docs = [a, b]
+    asyncio.run(catalog.refresh())
+    delta = catalog.snapshot(server.SubscriptionTier.FREE, known)
+    assert not delta.full
+    assert [s.id for s in delta.servers] == [b["id"]]
+    assert delta.removed == [c["id"]]
+
+    full = catalog.snapshot(server.SubscriptionTier.FREE, "unknown-version")
+    assert full.full and {s.id for s in full.servers} == {a["id"], b["id"]}
+
+
+def test_load_changes_do_not_produce_deltas(server, fake_db, catalog):
+    fake_db.proxy_servers.docs = [proxy_doc(server, "a"), proxy_doc(server, "b")]
+    asyncio.run(catalog.refresh())
+    known = catalog.tier_versions[server.SubscriptionTier.FREE]
+
+    for doc in fake_db.proxy_servers.docs:
+        doc["load_percentage"] = 75
+    asyncio.run(catalog.refresh())
+    assert catalog.tier_versions[server.SubscriptionTier.FREE] == known
+    assert catalog.snapshot(server.SubscriptionTier.FREE, known).servers == []
+
+
+def test_subscription_state_survives_rollup_failure(server, fake_db):
+    user = server.User(email="alice@example.com", password_hash="x", subscription_tier=server.SubscriptionTier.PREMIUM)
+    state = asyncio.run(server.build_subscription_state(user))
+    assert state.tier == server.SubscriptionTier.PREMIUM
+    assert state.is_active
+    assert state.usage_today_bytes is None
+
+
+def test_guest_bootstrap_returns_catalog_and_loads(server, fake_db, catalog):
+    from fastapi.testclient import TestClient
+
+    free, premium = proxy_doc(server, "a", load_percentage=20), proxy_doc(server, "premium", is_premium=True)
+    fake_db.proxy_servers.docs = [free, premium]
+    asyncio.run(catalog.refresh())
+
+    body = TestClient(server.app).get("/api/bootstrap").json()
+    assert body["profile"] is None
+    assert body["subscription"]["tier"] == "free"
+    assert body["catalog"]["full"] is True
+    assert [s["id"] for s in body["catalog"]["servers"]] == [free["id"]]
+    assert body["recommended_server"]["id"] == free["id"]
+    # The stored 20 is stale after a restart; both views report the tracker's load
+    assert body["recommended_server"]["load_percentage"] == 0
+    assert body["loads"] == {free["id"]: 0}
+
+
+def test_guest_schema_matches_cached_body(server):
+    from fastapi.testclient import TestClient
+
+    schema = TestClient(server.app).get("/openapi.json").json()
+    response = schema["paths"]["/api/proxies/guest"]["get"]["responses"]["200"]["content"]["application/json"]["schema"]
+    entry = schema["components"]["schemas"][response["items"]["$ref"].rsplit("/", 1)[-1]]
+    assert "load_percentage" not in entry["properties"]
+    assert set(entry["properties"]) == set(server.ProxyServer.model_fields) - server.VOLATILE_SERVER_FIELDS
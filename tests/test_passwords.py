@@ -0,0 +1,15 @@
+def test_calibration_never_goes_below_floor(server, monkeypatch):
+    # A slow or busy host: even the floor exceeds the target
+    monkeypatch.setattr(server, "measure_bcrypt_ms", lambda rounds: 1000.0)
+    assert server.calibrate_bcrypt_rounds(target_ms=250) == server.BCRYPT_MIN_ROUNDS
+
+
+def test_calibration_raises_cost_on_fast_hosts(server, monkeypatch):
+    monkeypatch.setattr(server, "measure_bcrypt_ms", lambda rounds: 30.0)
+    # 30ms at the floor doubles per round: 60, 120, 240 fit a 250ms target
+    assert server.calibrate_bcrypt_rounds(target_ms=250) == server.BCRYPT_MIN_ROUNDS + 3
+
+
+def test_bcrypt_cost_parsing(server):
+    assert server.bcrypt_cost("$2b$12$" + "x" * 53) == 12
+    assert server.bcrypt_cost("not-a-hash") == 0
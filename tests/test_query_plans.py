@@ -0,0 +1,202 @@
+"""
+Query plan regression tests for the VPN API
+
+Runs every route against a local mongod seeded with realistic volumes, captures
+the Mongo commands each one issues and checks explain("executionStats") for
+collection scans and wasteful examined-to-returned ratios.
+
+    QUERY_PLAN_MONGO_URL=mongodb://localhost:27017 python -m pytest tests/test_query_plans.py -s
+"""
+
+import json
+import os
+import random
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+pymongo = pytest.importorskip("pymongo")
+pytest.importorskip("fastapi")
+pytest.importorskip("motor")
+
+MONGO_URL = os.environ.get("QUERY_PLAN_MONGO_URL", "mongodb://localhost:27017")
+DB_NAME = os.environ.get("QUERY_PLAN_DB_NAME", "vpn_query_plan_test")
+SEED_USERS = int(os.environ.get("QUERY_PLAN_SEED_USERS", "50000"))
+SEED_PROXIES = int(os.environ.get("QUERY_PLAN_SEED_PROXIES", "500"))
+SEED_ROLLUP_USERS = int(os.environ.get("QUERY_PLAN_SEED_ROLLUP_USERS", "2000"))
+MAX_EXAMINED_PER_RETURNED = float(os.environ.get("QUERY_PLAN_MAX_EXAMINED_RATIO", "5"))
+
+try:
+    mongo = pymongo.MongoClient(MONGO_URL, serverSelectionTimeoutMS=2000)
+    mongo.admin.command("ping")
+except pymongo.errors.PyMongoError:
+    pytest.skip(f"No mongod reachable at {MONGO_URL}", allow_module_level=True)
+
+from fastapi.testclient import TestClient  # noqa: E402
+from motor.motor_asyncio import AsyncIOMotorClient  # noqa: E402
+
+
+def seed_database(server, database):
+    now = datetime.utcnow()
+    database.users.insert_many(
+        {
+            "id": str(uuid.uuid4()),
+            "email": f"seed_{i}@example.com",
+            "password_hash": "$2b$12$" + "x" * 53,
+            "subscription_tier": random.choice(["free", "premium"]),
+            "subscription_expires_at": None,
+            "created_at": now,
+            "last_login": None,
+            "is_active": True,
+        }
+        for i in range(SEED_USERS)
+    )
+
+    proxy_types = ["http", "https", "socks5", "openvpn", "wireguard"]
+    database.proxy_servers.insert_many(
+        {
+            "id": str(uuid.uuid4()),
+            "name": f"Seed {i}",
+            "country": f"Country {i % 40}",
+            "country_code": f"C{i % 40}",
+            "city": f"City {i % 120}",
+            "proxy_type": proxy_types[i % len(proxy_types)],
+            "host": f"seed-{i}.nvpn.com",
+            "port": 443,
+            "is_premium": i % 2 == 1,
+            "is_online": True,
+            "load_percentage": random.randint(0, 100),
+            "ping_ms": random.randint(5, 200),
+            "capacity": server.DEFAULT_SERVER_CAPACITY,
+            "wireguard_public_key": server.generate_wireguard_keypair()[1] if i % len(proxy_types) == 4 else None,
+            "created_at": now,
+        }
+        for i in range(SEED_PROXIES)
+    )
+
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    database.usage_rollups_daily.insert_many(
+        {
+            "user_id": str(uuid.uuid4()),
+            "proxy_id": str(uuid.uuid4()),
+            "bucket": today - timedelta(days=day),
+            "bytes_sent": random.randint(0, 10 ** 9),
+            "bytes_received": random.randint(0, 10 ** 9),
+            "connected_seconds": random.randint(0, 86400),
+        }
+        for _ in range(SEED_ROLLUP_USERS)
+        for day in range(30)
+    )
+
+
+def plan_stages(plan):
+    # Slot-based engine explains wrap the classic tree in "queryPlan"
+    plan = plan.get("queryPlan", plan)
+    yield plan["stage"]
+    if "inputStage" in plan:
+        yield from plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        yield from plan_stages(child)
+
+
+@pytest.fixture(scope="module")
+def plan_server(server):
+    """Point the app at the query plan database and capture every trace, restoring both afterwards"""
+    captured = []
+    plan_client = AsyncIOMotorClient(MONGO_URL, event_listeners=[server.MongoCommandTracer()])
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(server, "client", plan_client)
+        mp.setattr(server, "db", plan_client[DB_NAME])
+        mp.setattr(server, "TRACE_SLOW_REQUEST_MS", 0)
+        mp.setattr(server, "WIREGUARD_NODE_TOKEN", "query-plan-node")
+        mp.setattr(server.trace_exporter, "keep", lambda trace, root, status_code, slow: captured.append(list(trace.queries)))
+        yield server, captured
+    plan_client.close()
+
+
+@pytest.fixture(scope="module")
+def route_queries(plan_server):
+    """Exercise every route and return (route, database, command) for each query it ran"""
+    server, captured = plan_server
+    mongo.drop_database(DB_NAME)
+    seed_database(server, mongo[DB_NAME])
+
+    free_proxy = mongo[DB_NAME].proxy_servers.find_one({"is_premium": False})
+    wireguard_proxy = mongo[DB_NAME].proxy_servers.find_one({"is_premium": True, "proxy_type": "wireguard"})
+    email = f"query_plan_{uuid.uuid4().hex[:8]}@example.com"
+    password = "SecurePassword123!"
+    queries = []
+
+    with TestClient(server.app) as client:
+        headers = {}
+
+        def call(route, method, path, **kwargs):
+            del captured[:]
+            response = client.request(method, f"/api{path}", headers={**headers, **kwargs.pop("headers", {})}, **kwargs)
+            assert response.status_code < 400, f"{route} returned {response.status_code}: {response.text}"
+            for trace_queries in captured:
+                queries.extend((route, database, command) for _, database, command in trace_queries)
+            return response
+
+        token = call("POST /auth/register", "POST", "/auth/register", json={"email": email, "password": password}).json()["access_token"]
+        headers["Authorization"] = f"Bearer {token}"
+        call("POST /auth/login", "POST", "/auth/login", json={"email": email, "password": password})
+        call("GET /auth/profile", "GET", "/auth/profile")
+        call("POST /auth/forgot-password", "POST", "/auth/forgot-password", json={"email": email})
+        call("GET /proxies/guest", "GET", "/proxies/guest")
+        call("GET /proxies (free)", "GET", "/proxies")
+        call("GET /proxies/{id}", "GET", f"/proxies/{free_proxy['id']}")
+        call("POST /sessions/start", "POST", "/sessions/start", json={"proxy_id": free_proxy["id"]})
+        call("GET /usage", "GET", "/usage")
+        token = call("POST /subscription/upgrade", "POST", "/subscription/upgrade").json()["access_token"]
+        headers["Authorization"] = f"Bearer {token}"
+        call("GET /proxies (premium)", "GET", "/proxies")
+        call("GET /proxies/{id}/config", "GET", f"/proxies/{wireguard_proxy['id']}/config")
+        call("GET /proxies/{id}/peers", "GET", f"/proxies/{wireguard_proxy['id']}/peers", headers={"X-Node-Token": "query-plan-node"})
+        call("GET /bootstrap", "GET", "/bootstrap")
+
+    yield queries
+
+    mongo.drop_database(DB_NAME)
+
+
+def test_routes_issue_queries(route_queries):
+    routes = {route for route, _, _ in route_queries}
+    assert "POST /auth/login" in routes
+    assert "GET /auth/profile" in routes
+    assert "GET /proxies/{id}" in routes
+    assert "GET /usage" in routes
+    assert "GET /bootstrap" in routes
+
+
+def test_query_plans_use_indexes(server, route_queries, request):
+    reporter = request.config.pluginmanager.get_plugin("terminalreporter")
+    failures = []
+    rows = []
+
+    for route, database, command in route_queries:
+        name = next(iter(command))
+        collection = command[name]
+        query = server.query_filter(command)
+        plan = mongo[database].command({"explain": command, "verbosity": "executionStats"})
+        stages = list(plan_stages(plan["queryPlanner"]["winningPlan"]))
+        stats = plan["executionStats"]
+        examined = stats.get("totalDocsExamined", 0)
+        returned = stats.get("nReturned", 0)
+        shape = json.dumps(server.redact_values(query), sort_keys=True)
+        rows.append((route, f"{name} {collection}", shape, stages[-1], examined, returned, stats.get("executionTimeMillis", 0)))
+
+        # An empty find filter is an intentional full listing and cannot use an index
+        if "COLLSCAN" in stages and not (name == "find" and not query):
+            failures.append(f"{route}: {name} on {collection} with {shape} is a collection scan")
+        elif examined / max(returned, 1) > MAX_EXAMINED_PER_RETURNED:
+            failures.append(f"{route}: {name} on {collection} with {shape} examined {examined} docs for {returned} returned")
+
+    if reporter is not None:
+        reporter.write_line("")
+        reporter.write_line(f"{'route':<28} {'command':<28} {'shape':<44} {'stage':<10} {'examined':>9} {'returned':>9} {'ms':>5}")
+        for route, command, shape, stage, examined, returned, millis in rows:
+            reporter.write_line(f"{route:<28} {command:<28} {shape:<44} {stage:<10} {examined:>9} {returned:>9} {millis:>5}")
+
+    assert not failures, "\n".join(failures)
@@ -0,0 +1,147 @@
+import pytest
+
+
+@pytest.fixture
+def tracker(server):
+    return server.SessionTracker(timeout_seconds=3)
+
+
+def advance(tracker, ticks):
+    return sum(tracker.advance() for _ in range(ticks))
+
+
+def test_session_expires_without_heartbeat(tracker):
+    session_id = tracker.start("p1", "u1", capacity=10)
+    assert advance(tracker, 2) == 0
+    assert advance(tracker, 1) == 1
+    assert session_id not in tracker.sessions
+    assert tracker.active_counts.get("p1", 0) == 0
+
+
+def test_heartbeat_pushes_back_expiry(tracker):
+    session_id = tracker.start("p1", "u1", capacity=10)
+    advance(tracker, 2)
+    assert tracker.heartbeat(session_id) is not None
+    assert advance(tracker, 2) == 0
+    assert advance(tracker, 1) == 1
+
+
+def test_heartbeat_unknown_session(tracker):
+    assert tracker.heartbeat("missing") is None
+
+
+def test_stop_releases_slot_and_is_idempotent(tracker):
+    session_id = tracker.start("p1", "u1", capacity=10)
+    assert tracker.stop(session_id) is not None
+    assert tracker.stop(session_id) is None
+    assert tracker.active_counts.get("p1", 0) == 0
+    assert advance(tracker, 5) == 0
+
+
+def test_drain_dirty_reports_load_once(tracker):
+    tracker.start("p1", "u1", capacity=4)
+    tracker.start("p1", "u2", capacity=4)
+    assert tracker.drain_dirty() == {"p1": 50}
+    assert tracker.drain_dirty() == {}
+
+
+def test_expiry_marks_server_dirty(tracker):
+    tracker.start("p1", "u1", capacity=4)
+    tracker.drain_dirty()
+    advance(tracker, 3)
+    assert tracker.drain_dirty() == {"p1": 0}
+
+
+def test_try_start_respects_capacity(tracker):
+    assert tracker.try_start("p1", "u1", capacity=1) is not None
+    assert tracker.try_start("p1", "u2", capacity=1) is None
+    assert tracker.active_counts["p1"] == 1
+
+
+def test_reservation_is_claimed_into_live_session(server, tracker):
+    reservation_id = tracker.reserve("p1", capacity=2)
+    assert tracker.heartbeat(reservation_id) is None
+    assert tracker.claim(reservation_id, "p2", "u1") is None
+
+    session = tracker.claim(reservation_id, "p1", "u1")
+    assert session.user_id == "u1" and not session.pending
+    assert tracker.claim(reservation_id, "p1", "u1") is None
+    assert tracker.heartbeat(reservation_id) is not None
+
+
+def test_unclaimed_reservation_expires(server):
+    tracker = server.SessionTracker(timeout_seconds=server.ASSIGNMENT_RESERVATION_SECONDS + 10)
+    tracker.reserve("p1", capacity=1)
+    assert tracker.reserve("p1", capacity=1) is None
+    assert advance(tracker, server.ASSIGNMENT_RESERVATION_SECONDS) == 1
+    assert tracker.reserve("p1", capacity=1) is not None
+
+
+def make_server(server, name, capacity=10, **fields):
+    return server.ProxyServer(
+        name=name, country="Turkey", country_code="TR", city="Istanbul",
+        proxy_type="https", host=f"{name}.nvpn.com", port=443, capacity=capacity, **fields
+    )
+
+
+@pytest.fixture
+def live_tracker(server, monkeypatch):
+    tracker = server.SessionTracker()
+    monkeypatch.setattr(server, "session_tracker", tracker)
+    return tracker
+
+
+def test_pick_server_skips_full_servers(server, live_tracker):
+    full, free = make_server(server, "full", capacity=1), make_server(server, "free", capacity=1)
+    live_tracker.start(full.id, None, full.capacity)
+    for _ in range(20):
+        assert server.pick_server([full, free]) is free
+    live_tracker.start(free.id, None, free.capacity)
+    assert server.pick_server([full, free]) is None
+
+
+def test_pick_server_prefers_less_loaded_of_two(server, live_tracker):
+    busy, idle = make_server(server, "busy"), make_server(server, "idle")
+    for _ in range(5):
+        live_tracker.start(busy.id, None, busy.capacity)
+    assert all(server.pick_server([busy, idle]) is idle for _ in range(20))
+
+
+@pytest.fixture
+def catalog(server, monkeypatch):
+    catalog = server.ProxyCatalog()
+    monkeypatch.setattr(server, "proxy_catalog", catalog)
+    return catalog
+
+
+def add_to_catalog(catalog, proxy):
+    catalog.servers[proxy.id] = proxy
+    for key in {proxy.country.lower(), proxy.country_code.lower(), proxy.city.lower()}:
+        catalog.by_location.setdefault(key, []).append(proxy.id)
+
+
+def test_assign_never_oversubscribes(server, live_tracker, catalog):
+    from fastapi.testclient import TestClient
+
+    for name in ("a", "b"):
+        add_to_catalog(catalog, make_server(server, name, capacity=2))
+    add_to_catalog(catalog, make_server(server, "premium", capacity=2, is_premium=True))
+    client = TestClient(server.app)
+
+    statuses = [client.post("/api/proxies/assign", json={"city": "istanbul"}).status_code for _ in range(5)]
+    assert statuses == [200, 200, 200, 200, 503]
+    premium = next(p for p in catalog.servers.values() if p.is_premium)
+    assert live_tracker.active_counts.get(premium.id, 0) == 0
+
+
+def test_assign_uses_premium_servers_for_premium_tokens(server, live_tracker, catalog):
+    from fastapi.testclient import TestClient
+
+    premium = make_server(server, "premium", is_premium=True)
+    add_to_catalog(catalog, premium)
+    client = TestClient(server.app)
+    token = server.create_access_token("u1", server.SubscriptionTier.PREMIUM)
+
+    assert client.post("/api/proxies/assign", json={"country": "TR"}).status_code == 404
+    response = client.post("/api/proxies/assign", json={"country": "TR"}, headers={"Authorization": f"Bearer {token}"})
+    assert response.json()["server"]["id"] == premium.id
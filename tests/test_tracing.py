@@ -0,0 +1,117 @@
+import asyncio
+import json
+
+import pytest
+
+
+class FakeDatabase:
+    def __init__(self, plan):
+        self.plan = plan
+        self.explained = []
+
+    async def command(self, command):
+        self.explained.append(command)
+        await asyncio.sleep(0)
+        return self.plan
+
+
+class FakeClient:
+    def __init__(self, database):
+        self.database = database
+
+    def __getitem__(self, name):
+        return self.database
+
+
+def login_plan(email):
+    return {
+        "queryPlanner": {
+            "parsedQuery": {"email": {"$eq": email}},
+            "winningPlan": {
+                "stage": "FETCH",
+                "inputStage": {"stage": "IXSCAN", "indexBounds": {"email": [f'["{email}", "{email}"]']}},
+            },
+        },
+        "executionStats": {"nReturned": 1, "totalDocsExamined": 1, "allPlansExecution": []},
+    }
+
+
+def make_trace(server, email):
+    trace = server.Trace()
+    span = server.Span("find users", None, {})
+    trace.queries.append((span, "vpn", {"find": "users", "filter": {"email": email}}))
+    return trace, span
+
+
+@pytest.fixture
+def fake_db(server, monkeypatch):
+    database = FakeDatabase(login_plan("alice@example.com"))
+    monkeypatch.setattr(server, "client", FakeClient(database))
+    monkeypatch.setattr(server, "trace_exporter", server.TraceExporter())
+    return database
+
+
+def test_explain_output_is_redacted(server, fake_db):
+    trace, span = make_trace(server, "alice@example.com")
+    asyncio.run(server.trace_exporter._explain(trace))
+
+    explain = json.loads(span.attributes["db.explain"])
+    assert "alice@example.com" not in span.attributes["db.explain"]
+    assert explain["queryPlanner"]["parsedQuery"] == {"email": {"$eq": "?"}}
+    assert explain["queryPlanner"]["winningPlan"]["inputStage"]["stage"] == "IXSCAN"
+    assert "allPlansExecution" not in explain["executionStats"]
+
+
+def test_same_shape_is_explained_once_per_interval(server, fake_db, monkeypatch):
+    first, _ = make_trace(server, "alice@example.com")
+    second, span = make_trace(server, "bob@example.com")
+    asyncio.run(server.trace_exporter._explain(first))
+    asyncio.run(server.trace_exporter._explain(second))
+
+    assert len(fake_db.explained) == 1
+    assert span.attributes["db.explain_skipped"] == "shape explained recently"
+
+    monkeypatch.setattr(server, "TRACE_EXPLAIN_INTERVAL_SECONDS", 0)
+    asyncio.run(server.trace_exporter._explain(second))
+    assert len(fake_db.explained) == 2
+
+
+def test_explains_respect_concurrency_cap(server, fake_db):
+    traces = []
+    for i in range(server.TRACE_EXPLAIN_CONCURRENCY + 2):
+        trace = server.Trace()
+        span = server.Span("find", None, {})
+        trace.queries.append((span, "vpn", {"find": f"collection_{i}", "filter": {}}))
+        traces.append((trace, span))
+
+    async def explain_all():
+        server.trace_exporter.explain_slots = asyncio.Semaphore(server.TRACE_EXPLAIN_CONCURRENCY)
+        await asyncio.gather(*(server.trace_exporter._explain(trace) for trace, _ in traces))
+
+    asyncio.run(explain_all())
+
+    skipped = [span for _, span in traces if "db.explain_skipped" in span.attributes]
+    assert len(fake_db.explained) == server.TRACE_EXPLAIN_CONCURRENCY
+    assert len(skipped) == 2
+
+
+def test_query_filter_finds_write_filters(server):
+    assert server.query_filter({"update": "users", "updates": [{"q": {"id": "u1"}, "u": {}}]}) == {"id": "u1"}
+    assert server.query_filter({"aggregate": "usage", "pipeline": [{"$match": {"user_id": "u1"}}]}) == {"user_id": "u1"}
+    assert server.redact_values({"$or": [{"a": 1}, {"b": "x"}]}) == {"$or": [{"a": "?"}, {"b": "?"}]}
+
+
+def test_trace_file_rotates_by_size(server, tmp_path, monkeypatch):
+    path = tmp_path / "traces" / "traces.jsonl"
+    monkeypatch.setattr(server, "TRACE_EXPORT_PATH", str(path))
+    monkeypatch.setattr(server, "TRACE_EXPORT_MAX_BYTES", 500)
+    monkeypatch.setattr(server, "TRACE_EXPORT_BACKUP_COUNT", 2)
+    exporter = server.TraceExporter()
+
+    for i in range(50):
+        exporter._write_file({"trace_id": f"{i:032x}", "name": "GET /api/proxies", "duration_ms": 12.5})
+
+    files = sorted(p.name for p in path.parent.iterdir())
+    assert files == ["traces.jsonl", "traces.jsonl.1", "traces.jsonl.2"]
+    assert all(p.stat().st_size <= 500 for p in path.parent.iterdir())
+    assert json.loads(path.read_text().splitlines()[-1])["trace_id"] == f"{49:032x}"
@@ -0,0 +1,168 @@
+import asyncio
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+
+def bulk_error(indexes, code=1):
+    return BulkWriteError({"writeErrors": [{"index": i, "code": code, "errmsg": "boom"} for i in indexes]})
+
+
+class FakeSamples:
+    def __init__(self):
+        self.docs = []
+        self.fail_indexes = None
+
+    async def insert_many(self, docs, ordered=True):
+        if self.fail_indexes is None:
+            self.docs.extend(docs)
+            return
+        failed, self.fail_indexes = self.fail_indexes, None
+        self.docs.extend(doc for i, doc in enumerate(docs) if i not in failed)
+        raise bulk_error(failed)
+
+
+class FakeRollups:
+    """Applies guarded upserts like Mongo, including the duplicate key error for an already applied batch"""
+
+    def __init__(self):
+        self.totals = {}
+        self.failures = []
+
+    @staticmethod
+    def _key(query):
+        return (query["user_id"], query["proxy_id"], query["bucket"])
+
+    async def bulk_write(self, ops, ordered=True):
+        failure = self.failures.pop(0) if self.failures else None
+        if failure == "all":
+            raise ConnectionError("mongo down")
+        duplicates = set()
+        for i, op in enumerate(ops):
+            if failure not in (None, "timeout") and i in failure:
+                continue
+            batch_id = op._filter["applied"]["$ne"]
+            entry = self.totals.get(self._key(op._filter))
+            if entry is not None and batch_id in entry["applied"]:
+                duplicates.add(i)
+                continue
+            entry = self.totals.setdefault(
+                self._key(op._filter), {"bytes_sent": 0, "bytes_received": 0, "connected_seconds": 0, "applied": []}
+            )
+            for field, amount in op._doc["$inc"].items():
+                entry[field] += amount
+            entry["applied"].append(batch_id)
+        if failure == "timeout":
+            # The writes landed but the acknowledgement never arrived
+            raise ConnectionError("timed out")
+        if duplicates:
+            raise bulk_error(duplicates, code=11000)
+        if failure:
+            raise bulk_error(failure)
+
+    async def find_one(self, query, projection=None):
+        entry = self.totals.get(self._key(query))
+        return {"_id": 1} if entry is not None and query["applied"] in entry["applied"] else None
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.usage_samples = FakeSamples()
+        self.usage_rollups_hourly = FakeRollups()
+        self.usage_rollups_daily = FakeRollups()
+
+
+@pytest.fixture
+def fake_db(server, monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "db", database)
+    return database
+
+
+def report(server, sent=100):
+    return server.UsageReport(session_id="s", bytes_sent=sent, bytes_received=10, connected_seconds=60)
+
+
+def daily_sent(database):
+    return sum(entry["bytes_sent"] for entry in database.usage_rollups_daily.totals.values())
+
+
+def test_partial_insert_failure_only_requeues_failed_samples(server, fake_db):
+    recorder = server.UsageRecorder()
+    for user in ("u1", "u2", "u3"):
+        recorder.record(user, "p1", report(server))
+    fake_db.usage_samples.fail_indexes = {1}
+
+    asyncio.run(recorder.flush())
+    assert len(fake_db.usage_samples.docs) == 2
+    assert [sample["meta"]["user_id"] for sample in recorder.buffer] == ["u2"]
+    assert daily_sent(fake_db) == 200
+
+    asyncio.run(recorder.flush())
+    assert len(fake_db.usage_samples.docs) == 3
+    assert daily_sent(fake_db) == 300
+
+
+def test_failed_rollups_are_retried_on_next_flush(server, fake_db):
+    recorder = server.UsageRecorder()
+    recorder.record("u1", "p1", report(server))
+    fake_db.usage_rollups_daily.failures = ["all"]
+
+    asyncio.run(recorder.flush())
+    assert daily_sent(fake_db) == 0
+    assert sum(entry["bytes_sent"] for entry in fake_db.usage_rollups_hourly.totals.values()) == 100
+
+    recorder.record("u1", "p1", report(server, sent=50))
+    asyncio.run(recorder.flush())
+    assert daily_sent(fake_db) == 150
+    assert not recorder.pending_rollups[server.UsageGranularity.DAY]
+
+
+def test_partial_rollup_failure_does_not_double_count(server, fake_db):
+    recorder = server.UsageRecorder()
+    recorder.record("u1", "p1", report(server))
+    recorder.record("u2", "p1", report(server))
+    fake_db.usage_rollups_daily.failures = [{1}]
+
+    asyncio.run(recorder.flush())
+    asyncio.run(recorder.flush())
+    assert daily_sent(fake_db) == 200
+    assert all(entry["bytes_sent"] == 100 for entry in fake_db.usage_rollups_daily.totals.values())
+
+
+def test_buffer_is_bounded(server, monkeypatch):
+    monkeypatch.setattr(server, "USAGE_MAX_BUFFERED_SAMPLES", 3)
+    recorder = server.UsageRecorder()
+    for sent in range(5):
+        recorder.record("u1", "p1", report(server, sent=sent))
+    assert [sample["bytes_sent"] for sample in recorder.buffer] == [2, 3, 4]
+    assert recorder.dropped == 2
+
+
+def test_rollup_retry_after_timeout_is_not_counted_twice(server, fake_db):
+    recorder = server.UsageRecorder()
+    recorder.record("u1", "p1", report(server))
+    fake_db.usage_rollups_daily.failures = ["timeout"]
+
+    asyncio.run(recorder.flush())
+    assert daily_sent(fake_db) == 100
+    assert recorder.pending_rollups[server.UsageGranularity.DAY]
+
+    recorder.record("u1", "p1", report(server, sent=50))
+    asyncio.run(recorder.flush())
+    assert daily_sent(fake_db) == 150
+    assert not recorder.pending_rollups[server.UsageGranularity.DAY]
+
+
+def test_pending_rollup_batches_are_bounded(server, fake_db, monkeypatch):
+    monkeypatch.setattr(server, "USAGE_MAX_PENDING_ROLLUP_BATCHES", 2)
+    recorder = server.UsageRecorder()
+    for sent in (1, 2, 3):
+        fake_db.usage_rollups_daily.failures = ["all"]
+        recorder.record("u1", "p1", report(server, sent=sent))
+        asyncio.run(recorder.flush())
+
+    assert len(recorder.pending_rollups[server.UsageGranularity.DAY]) == 2
+    assert recorder.dropped_rollup_batches == 1
+    asyncio.run(recorder.flush())
+    assert daily_sent(fake_db) == 5
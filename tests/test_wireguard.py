@@ -0,0 +1,171 @@
+import asyncio
+
+import pytest
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return self.docs
+
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = []
+
+    def _match(self, doc, query):
+        return all(
+            doc.get(key) in value["$in"] if isinstance(value, dict) else doc.get(key) == value
+            for key, value in query.items()
+        )
+
+    def find(self, query, projection=None):
+        return FakeCursor([dict(doc) for doc in self.docs if self._match(doc, query)])
+
+    async def find_one(self, query, projection=None):
+        return next((dict(doc) for doc in self.docs if self._match(doc, query)), None)
+
+    async def find_one_and_update(self, query, update, upsert=False, return_document=None):
+        doc = next((doc for doc in self.docs if self._match(doc, query)), None)
+        if doc is None:
+            if not upsert:
+                return None
+            doc = dict(query)
+            self.docs.append(doc)
+        for key, amount in update.get("$inc", {}).items():
+            doc[key] = doc.get(key, 0) + amount
+        doc.update(update.get("$set", {}))
+        return dict(doc)
+
+    async def insert_one(self, doc):
+        self.docs.append(doc)
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.wireguard_peers = FakeCollection()
+        self.wireguard_address_counters = FakeCollection()
+        self.users = FakeCollection()
+        self.proxy_servers = FakeCollection()
+
+
+@pytest.fixture
+def fake_db(server, monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "db", database)
+    return database
+
+
+def test_client_addresses_skip_network_and_gateway(server):
+    assert server.wireguard_client_address(1) == "10.64.0.2/32"
+    assert server.wireguard_client_address(254) == "10.64.0.255/32"
+    assert server.wireguard_client_address(255) == "10.64.1.0/32"
+
+
+def test_client_address_pool_exhaustion(server):
+    last = server.WIREGUARD_CLIENT_NETWORK.num_addresses - 3
+    assert server.wireguard_client_address(last) == "10.127.255.254/32"
+    with pytest.raises(server.HTTPException):
+        server.wireguard_client_address(last + 1)
+
+
+def test_peer_is_reused_after_cache_miss(server, fake_db):
+    first = asyncio.run(server.get_or_create_wireguard_peer("u1", "p1"))
+    again = asyncio.run(server.get_or_create_wireguard_peer("u1", "p1"))
+    assert again["private_key"] == first["private_key"]
+    assert again["address"] == first["address"]
+    assert len(fake_db.wireguard_peers.docs) == 1
+
+
+def test_peers_get_distinct_addresses_per_server(server, fake_db):
+    addresses = {asyncio.run(server.get_or_create_wireguard_peer(f"u{i}", "p1"))["address"] for i in range(50)}
+    assert len(addresses) == 50
+    other = asyncio.run(server.get_or_create_wireguard_peer("u0", "p2"))
+    assert other["address"] == "10.64.0.2/32"
+
+
+def test_rendered_config_uses_persisted_peer(server):
+    private_key, public_key = server.generate_wireguard_keypair()
+    proxy = server.ProxyServer(
+        name="Germany - Berlin", country="Germany", country_code="DE", city="Berlin",
+        proxy_type="wireguard", host="de-berlin.nvpn.com", port=51820, wireguard_public_key=public_key
+    )
+    config = server.render_wireguard_config({"private_key": private_key, "address": "10.64.0.2/32"}, proxy).decode()
+    assert f"PrivateKey = {private_key}" in config
+    assert "Address = 10.64.0.2/32" in config
+    assert "Endpoint = de-berlin.nvpn.com:51820" in config
+
+
+def test_peer_sync_requires_node_token(server, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    client = TestClient(server.app)
+    monkeypatch.setattr(server, "WIREGUARD_NODE_TOKEN", None)
+    assert client.get("/api/proxies/p1/peers").status_code == 503
+    monkeypatch.setattr(server, "WIREGUARD_NODE_TOKEN", "secret")
+    assert client.get("/api/proxies/p1/peers", headers={"X-Node-Token": "wrong"}).status_code == 401
+
+
+def test_peer_sync_drops_users_who_lost_access(server, fake_db, monkeypatch):
+    from datetime import datetime, timedelta
+    from fastapi.testclient import TestClient
+
+    proxy = server.ProxyServer(
+        name="Germany - Berlin", country="Germany", country_code="DE", city="Berlin",
+        proxy_type="wireguard", host="de-berlin.nvpn.com", port=51820, is_premium=True,
+        wireguard_public_key=server.generate_wireguard_keypair()[1]
+    )
+    catalog = server.ProxyCatalog()
+    catalog.servers[proxy.id] = proxy
+    monkeypatch.setattr(server, "proxy_catalog", catalog)
+    monkeypatch.setattr(server, "WIREGUARD_NODE_TOKEN", "secret")
+
+    now = datetime.utcnow()
+    fake_db.users.docs = [
+        {"id": "premium", "is_active": True, "subscription_tier": "premium", "subscription_expires_at": None},
+        {"id": "renewed", "is_active": True, "subscription_tier": "premium", "subscription_expires_at": now + timedelta(days=3)},
+        {"id": "expired", "is_active": True, "subscription_tier": "premium", "subscription_expires_at": now - timedelta(days=1)},
+        {"id": "downgraded", "is_active": True, "subscription_tier": "free", "subscription_expires_at": None},
+        {"id": "deactivated", "is_active": False, "subscription_tier": "premium", "subscription_expires_at": None},
+    ]
+    peers = {user["id"]: asyncio.run(server.get_or_create_wireguard_peer(user["id"], proxy.id)) for user in fake_db.users.docs}
+
+    response = TestClient(server.app).get(f"/api/proxies/{proxy.id}/peers", headers={"X-Node-Token": "secret"})
+    assert response.status_code == 200
+    assert sorted(peer["public_key"] for peer in response.json()) == sorted(
+        peers[user_id]["public_key"] for user_id in ("premium", "renewed")
+    )
+
+
+def test_node_registers_its_own_server_key(server, fake_db, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(server, "proxy_catalog", server.ProxyCatalog())
+    monkeypatch.setattr(server, "session_tracker", server.SessionTracker())
+    monkeypatch.setattr(server, "WIREGUARD_NODE_TOKEN", "secret")
+    # A server seeded before keys were provisioned has no wireguard_public_key
+    proxy = server.ProxyServer(
+        name="Germany - Berlin", country="Germany", country_code="DE", city="Berlin",
+        proxy_type="wireguard", host="de-berlin.nvpn.com", port=51820
+    )
+    fake_db.proxy_servers.docs = [proxy.dict()]
+    fake_db.users.docs = [server.User(id="u1", email="u1@example.com", password_hash="x").dict()]
+    asyncio.run(server.proxy_catalog.refresh())
+
+    client = TestClient(server.app)
+    user = {"Authorization": f"Bearer {server.create_access_token('u1', 'free')}"}
+    node = {"X-Node-Token": "secret"}
+    assert client.get(f"/api/proxies/{proxy.id}/config", headers=user).status_code == 503
+
+    public_key = server.generate_wireguard_keypair()[1]
+    url = f"/api/proxies/{proxy.id}/wireguard-key"
+    assert client.put(url, json={"public_key": public_key}, headers={"X-Node-Token": "wrong"}).status_code == 401
+    assert client.put(url, json={"public_key": "not-a-key"}, headers=node).status_code == 422
+    assert client.put("/api/proxies/missing/wireguard-key", json={"public_key": public_key}, headers=node).status_code == 404
+    assert client.put(url, json={"public_key": public_key}, headers=node).status_code == 200
+
+    config = client.get(f"/api/proxies/{proxy.id}/config", headers=user)
+    assert config.status_code == 200
+    assert f"PublicKey = {public_key}" in config.text